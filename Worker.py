@@ -1,63 +1,253 @@
 from qgis.core import *
 from PyQt4 import QtCore, QtGui
+import math
+import numpy as np
+import threading
 import traceback
-import time, math
+import time
+import profiling
+from threshold_core import DEFAULT_TILE_BUDGET, RangeScan, estimate_range, merge_ranges
+from mask_export import export_mask, layer_geotransform
+from mmap_reader import open_mapped
+
+# Minimum number of seconds between two refined range updates
+REFINE_INTERVAL = 0.25
+
+# Maps QGIS raster data types onto the NumPy dtype of the block's raw buffer
+DTYPES = {
+    QGis.Byte: np.uint8,
+    QGis.UInt16: np.uint16,
+    QGis.Int16: np.int16,
+    QGis.UInt32: np.uint32,
+    QGis.Int32: np.int32,
+    QGis.Float32: np.float32,
+    QGis.Float64: np.float64,
+}
+
+def block_to_array(block, rows, cols):
+    """Read the raw data buffer of a QgsRasterBlock into a NumPy array.
+
+    The pixels are copied once, out of the QByteArray that data() returns;
+    the array is read-only and no further copy is made.
+
+    :param block: Block returned by QgsRasterDataProvider.block().
+    :type block: QgsRasterBlock
+
+    :returns: A (rows, cols) array of the block's pixel values.
+    :rtype: numpy.ndarray
+    """
+    dtype = DTYPES.get(block.dataType())
+    if dtype is None:
+        raise TypeError("Unsupported raster data type '{}'".format(block.dataType()))
+    return np.frombuffer(bytes(block.data()), dtype=dtype).reshape(rows, cols)
+
+def tile_extent(extent, rows, cols, window):
+    """Map a pixel window onto the matching sub-rectangle of extent."""
+    row, col, height, width = window
+    xres = extent.width() / float(cols)
+    yres = extent.height() / float(rows)
+    return QgsRectangle(
+        extent.xMinimum() + col * xres,
+        extent.yMaximum() - (row + height) * yres,
+        extent.xMinimum() + (col + width) * xres,
+        extent.yMaximum() - row * yres)
+
+def extent_window(extent, rows, cols, region):
+    """Map a sub-rectangle of extent onto the pixel window covering it.
+
+    :returns: (row, col, height, width) clipped to the raster, or None
+        when region lies outside of extent.
+    """
+    xres = extent.width() / float(cols)
+    yres = extent.height() / float(rows)
+    col = max(int(math.floor((region.xMinimum() - extent.xMinimum()) / xres)), 0)
+    row = max(int(math.floor((extent.yMaximum() - region.yMaximum()) / yres)), 0)
+    col_end = min(int(math.ceil((region.xMaximum() - extent.xMinimum()) / xres)), cols)
+    row_end = min(int(math.ceil((extent.yMaximum() - region.yMinimum()) / yres)), rows)
+    if col_end <= col or row_end <= row:
+        return None
+    return (row, col, row_end - row, col_end - col)
+
+class ProviderReader(object):
+    """Reads pixel windows of a layer through its data provider.
+
+    With clone set, every calling thread gets its own clone of the
+    provider, as providers are not safe to share between threads.
+    Otherwise all reads go through the layer's own provider.
+    """
+
+    def __init__(self, layer, clone=True):
+        self.layer = layer
+        self.clone = clone
+        self.rows = layer.height()
+        self.cols = layer.width()
+        self.band_count = layer.bandCount()
+        self.extent = layer.dataProvider().extent()
+        self.local = threading.local()
+
+    def provider(self):
+        if not self.clone:
+            return self.layer.dataProvider()
+        provider = getattr(self.local, "provider", None)
+        if provider is None:
+            provider = self.layer.dataProvider().clone()
+            self.local.provider = provider
+        return provider
+
+    def dtype(self, band):
+        return np.dtype(DTYPES.get(self.layer.dataProvider().dataType(band), np.float64))
+
+    def read_extent(self, band, extent, height, width):
+        block = self.provider().block(band, extent, width, height)
+        nodata = block.noDataValue() if block.hasNoDataValue() else None
+        return block_to_array(block, height, width), nodata
+
+    def read(self, band, window):
+        """Return (values, nodata) for a (row, col, height, width) window."""
+        extent = tile_extent(self.extent, self.rows, self.cols, window)
+        return self.read_extent(band, extent, window[2], window[3])
+
+    def read_decimated(self, band, height, width):
+        # The provider resamples the request, from overviews where it has them
+        return self.read_extent(band, self.extent, height, width)
+
+def layer_reader(layer, clone=True):
+    """Fastest reader of the pixels of layer.
+
+    Local files in a layout that can be memory mapped are read straight
+    from the mapping, anything else through the data provider.
+    """
+    if layer.providerType() == 'gdal':
+        provider = layer.dataProvider()
+        bands = range(1, layer.bandCount() + 1)
+        nodata = [provider.srcNoDataValue(band) if provider.srcHasNoDataValue(band) else None
+                  for band in bands]
+        reader = open_mapped(layer.source(), nodata)
+        if reader is not None and (reader.rows, reader.cols, reader.band_count) == (
+                layer.height(), layer.width(), layer.bandCount()):
+            return reader
+    return ProviderReader(layer, clone)
 
 class Worker(QtCore.QObject):
-    def __init__(self, iface, layer):
+    def __init__(self, iface, layer, tile_budget=DEFAULT_TILE_BUDGET, threads=1, band=1, tiles=None,
+                 keep_tiles=False):
         QtCore.QObject.__init__(self)
         if isinstance(layer, QgsRasterLayer) is False:
             raise TypeError("Worker expected QgsRasterLayer, got '{}'".format(type(layer)))
         self.layer = layer
         self.killed = False
         self.iface = iface
+        self.tile_budget = tile_budget
+        self.threads = max(int(threads), 1)
+        # Band whose intermediate ranges are published through rangeUpdated;
+        # may be changed while the scan runs
+        self.band = band
+        # TileStats of every band from an earlier scan; when given, only
+        # their dirty tiles are scanned. Holds the new ones once finished.
+        self.tiles = tiles
+        # Whether a full scan keeps per tile statistics for later rescans
+        self.keep_tiles = keep_tiles
 
     def run(self):
         ret = None
-        try:   
-            # self.iface.messageBar().pushMessage("Entered try block")
-            provider = self.layer.dataProvider()
-            extent = provider.extent()
-            rows = self.layer.height()
-            cols = self.layer.width()
-            block = provider.block(1, extent, cols, rows)
-            
-            _min = float("inf")
-            _max = float("-inf")
-            pos_inf = float("inf")
-            neg_inf = float("-inf")
-            
-            total_pixels = rows*cols
-            steps = total_pixels // 1000
-            current_step = 0
-            search_step = 10
-            # self.iface.messageBar().pushMessage("Recieved: {} {} {} {}".format(rows, cols, total_pixels, steps))
-
-            for i in range(0, rows, search_step):
-                if self.killed:
-                    break
-                for j in range(0, cols, search_step):
-                    val = block.value(i, j)
-                    # print "got a value {}".format(val)
-                    if val != pos_inf and val != neg_inf and not math.isnan(val):
-                        if _min > val:
-                            _min = val
-                        elif _max < val:
-                            _max = val
-                    current_step = current_step + 1
-                    if current_step % 10000 == 0:
-                        self.progress.emit(current_step * search_step * 1000 / float(total_pixels))
-            if self.killed is False:
-                self.progress.emit(100)
-            ret = (_min, _max)
+        tracer = profiling.tracer()
+        started = time.time()
+        try:
+            ret = self.rescan() if self.tiles is not None else self.scan()
         except Exception, e:
             # raise e
             self.error.emit(e, traceback.format_exc())
+        tracer.record('scan', started)
         self.finished.emit(ret)
 
+    def scan(self):
+        """Range and histogram of every band, from every pixel."""
+        tracer = profiling.tracer()
+        reader = ProviderReader(self.layer, clone=self.threads > 1)
+        bands = range(1, reader.band_count + 1)
+
+        # Publish a coarse estimate straight away so the slider can be
+        # used while the exact scan below refines it.
+        with tracer.span('scan.estimate'):
+            sampled = [estimate_range(reader, band) for band in bands]
+        band = self.band
+        estimate = sampled[band - 1]
+        self.rangeUpdated.emit(band, estimate[0], estimate[1], False)
+        last_update = time.time()
+
+        # The estimate above went through the provider, which reads
+        # overviews; the full scan reads the file directly if it can
+        scan = RangeScan(layer_reader(self.layer, self.threads > 1), sampled,
+                         self.tile_budget, self.threads, keep_tiles=self.keep_tiles)
+        for fraction in scan.run(lambda: self.killed):
+            self.progress.emit(fraction * 100.0)
+            if self.band != band:
+                # The band on screen changed: publish its range right away
+                band = self.band
+                estimate = merge_ranges(sampled[band - 1], scan.ranges[band - 1])
+                last_update = time.time()
+                self.rangeUpdated.emit(band, estimate[0], estimate[1], False)
+                continue
+            refined = merge_ranges(estimate, scan.ranges[band - 1])
+            if refined != estimate and time.time() - last_update > REFINE_INTERVAL:
+                estimate = refined
+                last_update = time.time()
+                self.rangeUpdated.emit(band, estimate[0], estimate[1], False)
+        if self.keep_tiles and scan.complete():
+            self.tiles = scan.tiles
+        return scan.result()
+
+    def rescan(self):
+        """Range and histogram of every band, rescanning the dirty tiles
+        of self.tiles only."""
+        # Work on copies, so the statistics in use are never half updated
+        self.tiles = [tiles.copy() for tiles in self.tiles]
+        # A cloned provider or a fresh mapping, so no stale block is read
+        reader = layer_reader(self.layer)
+        for band, tiles in enumerate(self.tiles, 1):
+            for fraction in tiles.rescan(reader, band, self.threads, lambda: self.killed):
+                self.progress.emit((band - 1 + fraction) * 100.0 / len(self.tiles))
+        return tuple(tiles.result() for tiles in self.tiles)
+
     def kill(self):
         self.killed = True
 
     finished = QtCore.pyqtSignal(tuple)
     error = QtCore.pyqtSignal(Exception, basestring)
-    progress = QtCore.pyqtSignal(float)
\ No newline at end of file
+    progress = QtCore.pyqtSignal(float)
+    # band, min, max, and whether the range is exact (True) or sampled (False)
+    rangeUpdated = QtCore.pyqtSignal(int, float, float, bool)
+
+class ExportWorker(QtCore.QObject):
+    """Runs export_mask for a layer on a background thread."""
+
+    def __init__(self, layer, band, path, breaks, nbits=8, threads=1, tile_budget=DEFAULT_TILE_BUDGET,
+                 colors=None):
+        QtCore.QObject.__init__(self)
+        self.layer = layer
+        self.band = band
+        self.path = path
+        self.breaks = breaks
+        self.nbits = nbits
+        self.threads = threads
+        self.tile_budget = tile_budget
+        self.colors = colors
+        self.killed = False
+
+    def run(self):
+        ret = False
+        try:
+            ret = export_mask(layer_reader(self.layer), self.band, self.path,
+                              layer_geotransform(self.layer), self.layer.crs().toWkt(),
+                              self.breaks, self.nbits, self.threads, self.tile_budget,
+                              self.progress.emit, lambda: self.killed, self.colors)
+        except Exception, e:
+            self.error.emit(e, traceback.format_exc())
+        self.finished.emit(ret)
+
+    def kill(self):
+        self.killed = True
+
+    finished = QtCore.pyqtSignal(bool)
+    error = QtCore.pyqtSignal(Exception, basestring)
+    progress = QtCore.pyqtSignal(float)
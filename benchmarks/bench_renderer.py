@@ -0,0 +1,132 @@
+# coding=utf-8
+"""Cost of one threshold update of the layer's renderer.
+
+Compares, on the same raster layer:
+
+    rebuild     what render() did before renderers were kept per layer: a
+                new ramp shader, raster shader and pseudo colour renderer
+                installed with setRenderer on every update
+    update      Threshold.update_renderer(), which rewrites the ramp items
+                of the renderer installed on the first update
+
+Each update moves the threshold, so both paths change the ramp every
+time. With --draw, every update is also followed by a synchronous draw of
+the layer into an image the size of the canvas, giving the cost of a full
+update as the user sees it.
+
+Run from the plugin directory, with the QGIS environment set up (see
+scripts/run-env-linux.sh):
+
+    python benchmarks/bench_renderer.py --updates 200 --output renderer.json
+    python benchmarks/bench_renderer.py --raster tiles/big.tif --draw
+
+.. note:: This program is free software; you can redistribute it and/or modify
+     it under the terms of the GNU General Public License as published by
+     the Free Software Foundation; either version 2 of the License, or
+     (at your option) any later version.
+
+"""
+
+__author__ = 'ryan.constantino93@gmail.com'
+__date__ = '2017-07-05'
+__copyright__ = 'Copyright 2017, Ryan Constantino'
+
+import argparse
+import json
+import os
+import sys
+import time
+
+PLUGIN_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [PLUGIN_DIR, os.path.join(PLUGIN_DIR, 'test')]
+
+# Raster shipped with the plugin tests, used when no --raster is given
+TEST_RASTER = os.path.join(PLUGIN_DIR, 'test', 'tenbytenraster.asc')
+# Size, in pixels, of the image drawn per update with --draw
+CANVAS_SIZE = (1280, 800)
+
+
+def rebuild(layer, threshold, highlight, base):
+    """One update as render() made it before renderers were kept."""
+    from qgis.core import (QgsColorRampShader, QgsRasterShader,
+                           QgsSingleBandPseudoColorRenderer)
+    items = [QgsColorRampShader.ColorRampItem(threshold, highlight),
+             QgsColorRampShader.ColorRampItem(float("inf"), base)]
+    fcn = QgsColorRampShader()
+    fcn.setColorRampType(QgsColorRampShader.DISCRETE)
+    fcn.setColorRampItemList(items)
+    shader = QgsRasterShader()
+    shader.setRasterShaderFunction(fcn)
+    layer.setRenderer(QgsSingleBandPseudoColorRenderer(layer.dataProvider(), 1, shader))
+    layer.triggerRepaint()
+
+
+def draw(layer):
+    """Draw layer into a canvas sized image and wait for it."""
+    from PyQt4.QtCore import QSize
+    from qgis.core import QgsMapRendererSequentialJob, QgsMapSettings
+    settings = QgsMapSettings()
+    settings.setOutputSize(QSize(*CANVAS_SIZE))
+    settings.setLayers([layer.id()])
+    settings.setExtent(layer.extent())
+    job = QgsMapRendererSequentialJob(settings)
+    job.start()
+    job.waitForFinished()
+
+
+def measure(path, updates, with_draw):
+    """Seconds per update of both paths on the raster at path."""
+    from utilities import get_qgis_app
+    from qgis.core import QgsMapLayerRegistry, QgsRasterLayer
+    _, _, iface, _ = get_qgis_app()
+    import threshold_plugin
+
+    layer = QgsRasterLayer(path, 'bench')
+    if not layer.isValid():
+        raise IOError("Cannot open raster '{}'".format(path))
+    QgsMapLayerRegistry.instance().addMapLayer(layer)
+    stats = layer.dataProvider().bandStatistics(1)
+    lo, hi = stats.minimumValue, stats.maximumValue
+    thresholds = [lo + (hi - lo) * step / float(updates) for step in range(updates)]
+
+    plugin = threshold_plugin.Threshold(iface)
+    plugin.layer = layer
+    plugin.band = 1
+    results = {}
+    for name in ('rebuild', 'update'):
+        started = time.time()
+        for threshold in thresholds:
+            if name == 'rebuild':
+                rebuild(layer, threshold, plugin.HIGHLIGHT, plugin.BASE)
+            else:
+                plugin.threshold_current_value = threshold
+                plugin.update_renderer()
+            if with_draw:
+                draw(layer)
+        results[name] = (time.time() - started) / updates
+    QgsMapLayerRegistry.instance().removeMapLayer(layer.id())
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare renderer update paths.")
+    parser.add_argument('--raster', default=TEST_RASTER, help="Raster layer to update")
+    parser.add_argument('--updates', type=int, default=200, help="Threshold updates per path")
+    parser.add_argument('--draw', action='store_true', help="Draw the layer after every update")
+    parser.add_argument('--output', help="JSON file to write the results to")
+    args = parser.parse_args(argv)
+
+    seconds = measure(os.path.abspath(args.raster), max(args.updates, 1), args.draw)
+    for name in ('rebuild', 'update'):
+        print "{:<8} {:8.3f} ms per update".format(name, seconds[name] * 1000)
+    if seconds['update'] > 0:
+        print "update is {:.1f}x faster".format(seconds['rebuild'] / seconds['update'])
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'benchmark': 'renderer', 'raster': args.raster, 'updates': args.updates,
+                       'draw': args.draw, 'seconds_per_update': seconds}, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
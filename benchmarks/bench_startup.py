@@ -0,0 +1,103 @@
+# coding=utf-8
+"""Startup cost of the plugin.
+
+Measures, each in a fresh QGIS process so nothing is already imported:
+
+    import      importing threshold_plugin
+    construct   Threshold(iface), what QGIS runs for every enabled plugin
+    init_gui    Threshold.initGui()
+    first_use   building the dialog on the first run (not paid at startup)
+
+Run from the plugin directory, with the QGIS environment set up (see
+scripts/run-env-linux.sh):
+
+    python benchmarks/bench_startup.py --repeat 5 --output startup.json
+
+.. note:: This program is free software; you can redistribute it and/or modify
+     it under the terms of the GNU General Public License as published by
+     the Free Software Foundation; either version 2 of the License, or
+     (at your option) any later version.
+
+"""
+
+__author__ = 'ryan.constantino93@gmail.com'
+__date__ = '2017-07-05'
+__copyright__ = 'Copyright 2017, Ryan Constantino'
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+PLUGIN_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Modules whose import the startup path should not pay for
+HEAVY_MODULES = ('numpy', 'osgeo', 'threshold_plugin_dialog', 'Worker', 'resources')
+
+
+def measure():
+    """Time one cold start of the plugin in the current process."""
+    sys.path[:0] = [PLUGIN_DIR, os.path.join(PLUGIN_DIR, 'test')]
+    from utilities import get_qgis_app
+    _, _, iface, _ = get_qgis_app()
+    preloaded = [name for name in HEAVY_MODULES if name in sys.modules]
+    timings = {}
+
+    started = time.time()
+    import threshold_plugin
+    timings['import'] = time.time() - started
+
+    started = time.time()
+    plugin = threshold_plugin.Threshold(iface)
+    timings['construct'] = time.time() - started
+
+    started = time.time()
+    plugin.initGui()
+    timings['init_gui'] = time.time() - started
+    # Anything imported by now is paid at every QGIS startup
+    loaded = [name for name in HEAVY_MODULES if name in sys.modules and name not in preloaded]
+
+    started = time.time()
+    plugin.load()
+    timings['first_use'] = time.time() - started
+    plugin.unload()
+    return {'seconds': timings, 'heavy_modules_at_startup': loaded}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure the plugin's startup cost.")
+    parser.add_argument('--repeat', type=int, default=5, help="Number of cold starts")
+    parser.add_argument('--output', help="JSON file to write the results to")
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    if args.child:
+        print json.dumps(measure())
+        return 0
+
+    runs = []
+    for _ in range(args.repeat):
+        output = subprocess.check_output([sys.executable, os.path.abspath(__file__), '--child'])
+        runs.append(json.loads(output.strip().splitlines()[-1]))
+    stages = sorted(runs[0]['seconds'])
+    medians = dict((stage, sorted(run['seconds'][stage] for run in runs)[len(runs) // 2])
+                   for stage in stages)
+    result = {
+        'benchmark': 'startup',
+        'repeat': args.repeat,
+        'median_seconds': medians,
+        'heavy_modules_at_startup': runs[0]['heavy_modules_at_startup'],
+        'runs': runs,
+    }
+    for stage in ('import', 'construct', 'init_gui', 'first_use'):
+        print "{:<10} {:8.1f} ms".format(stage, medians[stage] * 1000)
+    if result['heavy_modules_at_startup']:
+        print "Imported at startup: {}".format(', '.join(result['heavy_modules_at_startup']))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
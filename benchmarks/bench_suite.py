@@ -0,0 +1,307 @@
+# coding=utf-8
+"""Benchmarks of the plugin's hot paths on synthetic rasters.
+
+Operations timed, on the QGIS free code in threshold_core and
+mask_export:
+
+    estimate    decimated read for the first range estimate
+    scan        exact range and histogram of every pixel (RangeScan)
+    histogram   histogram fill alone, without the range reduction
+    export      classified, tiled GeoTIFF export (export_mask)
+    render      preview update: one decimated read and quantization,
+                then a colour lookup per threshold change
+
+scan and export are run for every thread count given, which measures
+how they scale with threads. Pixels are read through GDAL, or also
+through the memory mapped reader with --readers gdal,mmap. Every case
+runs in a fresh process so that its peak memory is its own. Wall time,
+pixel throughput and peak RSS are written to a JSON file. A previous
+file can be passed to --compare to flag regressions. For example:
+
+    python benchmarks/bench_suite.py --output before.json
+    python benchmarks/bench_suite.py --sizes all --threads 1,2,4,8 \\
+        --output after.json --compare before.json
+
+Synthetic rasters are generated once into --data-dir; the largest
+(40000 x 40000 float32) takes 6.4 GB.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+     it under the terms of the GNU General Public License as published by
+     the Free Software Foundation; either version 2 of the License, or
+     (at your option) any later version.
+
+"""
+
+__author__ = 'ryan.constantino93@gmail.com'
+__date__ = '2017-07-05'
+__copyright__ = 'Copyright 2017, Ryan Constantino'
+
+import argparse
+from itertools import product
+import json
+import multiprocessing
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+PLUGIN_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [PLUGIN_DIR, os.path.dirname(os.path.abspath(__file__))]
+
+import synthetic
+
+ALL_SIZES = (1024, 4096, 10000, 20000, 40000)
+DEFAULT_SIZES = (1024, 4096)
+OPERATIONS = ('estimate', 'scan', 'histogram', 'export', 'render')
+# Operations run once per thread count
+THREADED = ('scan', 'export')
+# Canvas the render benchmark previews, in pixels
+CANVAS_SIZE = (1920, 1080)
+# Threshold changes timed per render case
+RENDER_UPDATES = 50
+
+
+def peak_rss_mb():
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, OS X bytes
+    return peak / (1024.0 * 1024.0) if sys.platform == 'darwin' else peak / 1024.0
+
+
+def bench_estimate(reader, case):
+    from threshold_core import estimate_range
+    estimate_range(reader, 1)
+    return {}
+
+
+def bench_scan(reader, case):
+    from threshold_core import RangeScan
+    scan = RangeScan(reader, tile_budget=case['tile_budget'], threads=case['threads'])
+    for _ in scan.run():
+        pass
+    return {'tiles': len(scan.windows)}
+
+
+def bench_histogram(reader, case):
+    from histogram import Histogram
+    from threshold_core import estimate_range, iter_tiles, tile_shape, valid_values
+    lo, hi = estimate_range(reader, 1)
+    dtype = reader.dtype(1)
+    histogram = Histogram.for_values(dtype, lo, hi)
+    tile_rows, tile_cols = tile_shape(reader.rows, reader.cols, dtype.itemsize, case['tile_budget'])
+    for window in iter_tiles(reader.rows, reader.cols, tile_rows, tile_cols):
+        histogram.add(valid_values(*reader.read(1, window)))
+    return {}
+
+
+def bench_export(reader, case):
+    from mask_export import export_mask
+    from threshold_core import estimate_range
+    lo, hi = estimate_range(reader, 1)
+    handle, path = tempfile.mkstemp(suffix='.tif', dir=case['scratch'])
+    os.close(handle)
+    try:
+        export_mask(reader, 1, path, reader.geotransform(), reader.wkt(), [(lo + hi) / 2.0],
+                    8, case['threads'], case['tile_budget'])
+        size = os.path.getsize(path)
+    finally:
+        os.remove(path)
+    return {'output_mb': size / (1024.0 * 1024.0)}
+
+
+def bench_render(reader, case):
+    from threshold_core import array_range, class_lut, quantize, valid_mask
+    started = time.time()
+    width = max(int(CANVAS_SIZE[0] * case['scale']), 1)
+    height = max(int(CANVAS_SIZE[1] * case['scale']), 1)
+    values, nodata = reader.read_decimated(1, height, width)
+    valid = valid_mask(values, nodata)
+    lo, hi = array_range(values, nodata)
+    index, levels = quantize(values, valid, lo, hi, 2)
+    prepare = time.time() - started
+
+    started = time.time()
+    for step in range(RENDER_UPDATES):
+        threshold = lo + (hi - lo) * step / float(RENDER_UPDATES)
+        lut = class_lut(levels, [threshold], [0xffffffff, 0xffff00ff])
+        lut.take(index).tobytes()
+    update = (time.time() - started) / RENDER_UPDATES
+    return {'prepare_ms': prepare * 1000, 'update_ms': update * 1000, 'preview_pixels': width * height}
+
+
+BENCHMARKS = {
+    'estimate': bench_estimate,
+    'scan': bench_scan,
+    'histogram': bench_histogram,
+    'export': bench_export,
+    'render': bench_render,
+}
+
+
+def run_case(case):
+    """Run one case in the current process and return its measurements."""
+    from mask_export import GdalReader
+    from mmap_reader import open_mapped
+    reader = GdalReader(case['path'])
+    if case['reader'] == 'mmap':
+        nodata = [reader.dataset().GetRasterBand(1).GetNoDataValue()]
+        source, reader = reader, open_mapped(case['path'], nodata)
+        if reader is None:
+            raise ValueError("{} cannot be memory mapped".format(case['path']))
+        # Geo referencing for the export still comes from GDAL
+        reader.geotransform, reader.wkt = source.geotransform, source.wkt
+    baseline = peak_rss_mb()
+    started = time.time()
+    extra = BENCHMARKS[case['operation']](reader, case)
+    wall = time.time() - started
+    result = {
+        'wall_seconds': wall,
+        'mpx_per_second': reader.rows * reader.cols / wall / 1e6 if wall > 0 else None,
+        'peak_rss_mb': peak_rss_mb(),
+        'baseline_rss_mb': baseline,
+    }
+    result.update(extra)
+    return result
+
+
+def case_key(case):
+    return (case['operation'], case['size'], case['dtype'], case['pattern'], case['threads'],
+            case.get('reader', 'gdal'))
+
+
+def build_cases(args):
+    cases = []
+    for size in args.sizes:
+        for dtype in args.dtypes:
+            for pattern in args.patterns:
+                if not synthetic.supports(dtype, pattern):
+                    continue
+                for operation, threads, reader in product(
+                        args.operations, args.threads, args.readers):
+                    if threads != args.threads[0] and operation not in THREADED:
+                        continue
+                    cases.append({
+                        'operation': operation,
+                        'size': size,
+                        'dtype': dtype,
+                        'pattern': pattern,
+                        'threads': threads if operation in THREADED else 1,
+                        'reader': reader,
+                        'tile_budget': args.tile_budget_mb * 1024 * 1024,
+                        'scale': args.preview_scale,
+                    })
+    return cases
+
+
+def environment():
+    info = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': multiprocessing.cpu_count(),
+    }
+    try:
+        import numpy
+        from osgeo import gdal
+        info.update(numpy=numpy.__version__, gdal=gdal.__version__)
+    except ImportError:
+        pass
+    try:
+        info['commit'] = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=PLUGIN_DIR, stderr=subprocess.STDOUT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        pass
+    return info
+
+
+def compare(results, previous_path, tolerance):
+    """Print the wall time ratio of every case also in a previous run."""
+    with open(previous_path) as f:
+        previous = dict((case_key(result), result) for result in json.load(f)['results'])
+    regressions = 0
+    for result in results:
+        before = previous.get(case_key(result))
+        if before is None:
+            continue
+        ratio = result['wall_seconds'] / before['wall_seconds'] if before['wall_seconds'] else float('inf')
+        flag = ''
+        if ratio > 1 + tolerance:
+            flag = '  REGRESSION'
+            regressions += 1
+        print "{:<40} {:6.2f}x{}".format(' '.join(str(part) for part in case_key(result)), ratio, flag)
+    return regressions
+
+
+def parse_list(text, cast=str):
+    return [cast(item) for item in text.split(',') if item]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the plugin's hot paths.")
+    parser.add_argument('--sizes', default=','.join(str(size) for size in DEFAULT_SIZES),
+                        help="Comma separated raster sides, or 'all'")
+    parser.add_argument('--dtypes', default=','.join(sorted(synthetic.DTYPES)))
+    parser.add_argument('--patterns', default=','.join(synthetic.PATTERNS))
+    parser.add_argument('--operations', default=','.join(OPERATIONS))
+    parser.add_argument('--threads', default='1,{}'.format(multiprocessing.cpu_count()),
+                        help="Thread counts for scan and export")
+    parser.add_argument('--readers', default='gdal',
+                        help="Comma separated pixel readers: gdal, mmap")
+    parser.add_argument('--tile-budget-mb', type=int, default=64)
+    parser.add_argument('--preview-scale', type=float, default=0.25)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--data-dir', default=os.path.join(tempfile.gettempdir(), 'threshold_bench'),
+                        help="Where synthetic rasters are kept between runs")
+    parser.add_argument('--output', help="JSON file to write the results to")
+    parser.add_argument('--compare', help="JSON results of an earlier run")
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help="Slowdown ratio over 1 reported as a regression")
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    if args.child:
+        print json.dumps(run_case(json.loads(args.child)))
+        return 0
+
+    args.sizes = list(ALL_SIZES) if args.sizes == 'all' else parse_list(args.sizes, int)
+    args.dtypes = parse_list(args.dtypes)
+    args.patterns = parse_list(args.patterns)
+    args.operations = parse_list(args.operations)
+    args.threads = parse_list(args.threads, int)
+    args.readers = parse_list(args.readers)
+
+    results = []
+    for case in build_cases(args):
+        case['path'] = synthetic.make_raster(args.data_dir, case['size'], case['dtype'], case['pattern'])
+        case['scratch'] = args.data_dir
+        runs = []
+        for _ in range(args.repeat):
+            output = subprocess.check_output([sys.executable, os.path.abspath(__file__),
+                                              '--child', json.dumps(case)])
+            runs.append(json.loads(output.strip().splitlines()[-1]))
+        walls = sorted(run['wall_seconds'] for run in runs)
+        result = dict(case)
+        result.update(runs[len(runs) // 2])
+        result.update(wall_seconds=walls[len(walls) // 2], walls=walls,
+                      peak_rss_mb=max(run['peak_rss_mb'] for run in runs))
+        del result['path'], result['scratch']
+        results.append(result)
+        print "{:<40} {:9.3f} s {:8.1f} Mpx/s {:8.0f} MB".format(
+            ' '.join(str(part) for part in case_key(case)), result['wall_seconds'],
+            result['mpx_per_second'] or 0.0, result['peak_rss_mb'])
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'benchmark': 'hot_paths',
+                'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'environment': environment(),
+                'results': results,
+            }, f, indent=2)
+    if args.compare:
+        return 1 if compare(results, args.compare, args.tolerance) else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,104 @@
+# coding=utf-8
+"""Synthetic rasters for the benchmarks.
+
+Rasters are written a strip at a time, so a 40000 x 40000 float32 file
+(6.4 GB) never needs more than a few hundred MB of memory, and they are
+kept in a cache directory between runs. Values are a smooth gradient
+plus noise, deterministic for a given size, type and pattern.
+
+Patterns:
+
+    clean     every pixel valid
+    nodata    stripes and scattered pixels set to the nodata value
+    nan       the same pixels set to NaN (float types only)
+
+.. note:: This program is free software; you can redistribute it and/or modify
+     it under the terms of the GNU General Public License as published by
+     the Free Software Foundation; either version 2 of the License, or
+     (at your option) any later version.
+
+"""
+
+__author__ = 'ryan.constantino93@gmail.com'
+__date__ = '2017-07-05'
+__copyright__ = 'Copyright 2017, Ryan Constantino'
+
+import os
+
+import numpy as np
+
+DTYPES = {
+    'byte': np.uint8,
+    'int16': np.int16,
+    'float32': np.float32,
+}
+NODATA = {
+    'byte': 0,
+    'int16': -9999,
+    'float32': -9999.0,
+}
+PATTERNS = ('clean', 'nodata', 'nan')
+# Rows generated and written at a time
+STRIP_ROWS = 512
+# Every STRIPE_PERIOD rows, STRIPE_ROWS rows are invalid in the patterns
+STRIPE_PERIOD = 1000
+STRIPE_ROWS = 50
+# Share of other pixels scattered invalid in the patterns
+SCATTER = 0.01
+
+
+def supports(dtype, pattern):
+    return pattern != 'nan' or np.dtype(DTYPES[dtype]).kind == 'f'
+
+
+def raster_name(size, dtype, pattern, extension='tif'):
+    return 'synthetic_{}_{}_{}.{}'.format(size, dtype, pattern, extension)
+
+
+def strip(size, dtype, pattern, row, rows):
+    """Values of rows [row, row + rows) of a synthetic raster."""
+    random = np.random.RandomState(row)
+    y = np.arange(row, row + rows, dtype=np.float32)[:, None] / size
+    x = np.arange(size, dtype=np.float32)[None, :] / size
+    values = 0.5 + 0.25 * np.sin(6.0 * x) * np.cos(4.0 * y)
+    values = values + random.normal(0.0, 0.05, (rows, size)).astype(np.float32)
+    if dtype == 'byte':
+        values = np.clip(values * 255, 1, 255).astype(np.uint8)
+    elif dtype == 'int16':
+        values = np.clip(values * 4000 - 1000, -5000, 5000).astype(np.int16)
+    else:
+        values = values.astype(np.float32)
+    if pattern != 'clean':
+        invalid = random.random_sample((rows, size)) < SCATTER
+        invalid[(np.arange(row, row + rows) % STRIPE_PERIOD) < STRIPE_ROWS] = True
+        values[invalid] = np.nan if pattern == 'nan' else NODATA[dtype]
+    return values
+
+
+def make_raster(directory, size, dtype, pattern):
+    """Return the path of a synthetic GeoTIFF, writing it if needed.
+
+    The GeoTIFF is uncompressed, so that timings measure the plugin rather
+    than the codec, and its strips are written back to back so that it
+    can also be read through the memory mapped reader.
+    """
+    from osgeo import gdal, gdal_array
+    path = os.path.join(directory, raster_name(size, dtype, pattern))
+    if os.path.isfile(path):
+        return path
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    partial = path + '.part'
+    gdal_type = gdal_array.NumericTypeCodeToGDALTypeCode(np.dtype(DTYPES[dtype]))
+    dataset = gdal.GetDriverByName('GTiff').Create(
+        partial, size, size, 1, gdal_type, ['BIGTIFF=YES'])
+    dataset.SetGeoTransform((0.0, 1.0, 0.0, float(size), 0.0, -1.0))
+    band = dataset.GetRasterBand(1)
+    if pattern == 'nodata':
+        band.SetNoDataValue(NODATA[dtype])
+    for row in range(0, size, STRIP_ROWS):
+        band.WriteArray(strip(size, dtype, pattern, row, min(STRIP_ROWS, size - row)), 0, row)
+    band.FlushCache()
+    band = dataset = None
+    os.rename(partial, path)
+    return path
@@ -0,0 +1,409 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ Threshold
+                                 A QGIS plugin
+ Adds context controls for brightness and contrast
+                              -------------------
+        begin                : 2017-07-05
+        git sha              : $Format:%H$
+        copyright            : (C) 2017 by Ryan Constantino
+        email                : ryan.constantino93@gmail.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+import copy
+import math
+import numpy as np
+
+# Number of bins used for rasters without an exact integer histogram
+DEFAULT_BINS = 1024
+# Bins a histogram grows to before it halves its resolution to take more
+MAX_BINS = 4 * DEFAULT_BINS
+
+
+class Histogram(object):
+    """Histogram of the valid pixel values of one band.
+
+    The bins are equally wide and aligned on an anchor, the lower edge the
+    histogram was created with. Values outside of them make the bins grow
+    to take them, and past max_bins every two neighbouring bins are merged
+    into one twice as wide. As bins never move off the anchor, counts are
+    never split across bins by guesswork: histograms created alike merge
+    exactly whatever values each was given, and bins laid over a sampled
+    range end up covering the exact one. Integer histograms have one bin
+    per value, or per run of 2, 4, ... values past max_bins, and answer
+    threshold queries exactly while a bin holds a single value.
+    """
+
+    def __init__(self, lo, hi, bins=DEFAULT_BINS, integer=False, sampled=False, max_bins=None):
+        """Constructor.
+
+        :param lo: Lower edge of the first bin, and the anchor of the bins.
+        :type lo: float
+
+        :param hi: Upper edge of the last bin. For integer histograms this
+            is the last value counted, so bins == hi - lo + 1.
+        :type hi: float
+
+        :param bins: Number of bins.
+        :type bins: int
+
+        :param integer: True for one bin per integer value.
+        :type integer: bool
+
+        :param sampled: True when the counts come from a sample of the
+            pixels rather than from all of them.
+        :type sampled: bool
+
+        :param max_bins: Most bins before they are coarsened; defaults to
+            MAX_BINS, or bins when that is more. An integer histogram over
+            more values than this starts with bins wider than one value.
+        :type max_bins: int
+        """
+        if integer:
+            lo, hi = int(math.floor(lo)), int(math.ceil(hi))
+            bins = hi - lo + 1
+            self.base = 1
+        else:
+            if not hi > lo:
+                hi = lo + 1.0
+            self.base = (hi - lo) / float(bins)
+        self.max_bins = max_bins or max(MAX_BINS, bins)
+        self.anchor = lo
+        self.level = 0
+        if integer:
+            while ((hi - lo) >> self.level) + 1 > self.max_bins:
+                self.level += 1
+            bins = ((hi - lo) >> self.level) + 1
+        # Position of the first bin, in bins of the current width from the anchor
+        self.first = 0
+        self.integer = integer
+        self.sampled = sampled
+        self.counts = np.zeros(bins, dtype=np.int64)
+        self._cumulative = None
+
+    @classmethod
+    def for_values(cls, dtype, lo, hi, bins=DEFAULT_BINS):
+        """Pick the histogram layout for pixels of dtype spanning [lo, hi].
+
+        8 and 16 bit integer rasters get an exact histogram over every
+        value their type can hold, so the bins never depend on lo and hi.
+        Wider integers get integer bins over [lo, hi], growing from there.
+        """
+        dtype = np.dtype(dtype)
+        if dtype.kind in 'iu':
+            if dtype.itemsize <= 2:
+                info = np.iinfo(dtype)
+                return cls(info.min, info.max, integer=True)
+            return cls(lo, hi, integer=True, max_bins=MAX_BINS)
+        return cls(lo, hi, bins)
+
+    @property
+    def bins(self):
+        return len(self.counts)
+
+    @property
+    def width(self):
+        """Width of every bin, in values."""
+        if self.integer:
+            return self.base << self.level
+        return self.base * 2.0 ** self.level
+
+    @property
+    def exact(self):
+        """Whether count_above() is exact for every threshold, as it is for
+        integer bins of one value filled from every pixel. Other bins are
+        split linearly, which miscounts values bunched inside a bin, such
+        as a spike at the minimum."""
+        return self.integer and self.width == 1 and not self.sampled
+
+    @property
+    def lo(self):
+        return self.anchor + self.first * self.width
+
+    @property
+    def hi(self):
+        if self.integer:
+            return self.lo + self.bins * self.width - 1
+        return self.lo + self.bins * self.width
+
+    def empty_like(self):
+        """Return an empty histogram with the same bins, for merging."""
+        histogram = copy.copy(self)
+        histogram.counts = np.zeros_like(self.counts)
+        histogram._cumulative = None
+        return histogram
+
+    def copy(self):
+        histogram = copy.copy(self)
+        histogram.counts = self.counts.copy()
+        histogram._cumulative = None
+        return histogram
+
+    def positions(self, values):
+        """Bin of every one of values, counted from the anchor in bins of
+        the current width. Float positions are left unrounded to int."""
+        if self.integer:
+            return (values.astype(np.int64) - self.anchor) >> self.level
+        return np.floor((values - self.anchor) / self.width)
+
+    def coarsen(self):
+        """Merge every two neighbouring bins into one twice as wide."""
+        positions = (self.first + np.arange(self.bins, dtype=np.int64)) >> 1
+        first = self.first >> 1
+        counts = np.zeros(int(positions[-1]) - first + 1, dtype=np.int64)
+        np.add.at(counts, positions - first, self.counts)
+        self.counts = counts
+        self.first = first
+        self.level += 1
+        self._cumulative = None
+
+    def grow(self, first, last):
+        """Extend the bins to positions [first, last], which must hold the
+        current ones."""
+        if first == self.first and last == self.first + self.bins - 1:
+            return
+        counts = np.zeros(last - first + 1, dtype=np.int64)
+        offset = self.first - first
+        counts[offset:offset + self.bins] = self.counts
+        self.counts = counts
+        self.first = first
+        self._cumulative = None
+
+    def cover(self, lowest, highest):
+        """Grow the bins, coarsening them past max_bins, to take every
+        value from lowest to highest, two values of the type to come."""
+        ends = np.array([lowest, highest])
+        while True:
+            low, high = self.positions(ends)
+            last = self.first + self.bins - 1
+            # The upper edge of the last float bin is counted in it
+            if not self.integer and highest <= self.hi:
+                high = min(high, last)
+            first, last = min(self.first, low), max(last, high)
+            if last - first + 1 <= self.max_bins:
+                break
+            self.coarsen()
+        self.grow(int(first), int(last))
+
+    def add(self, values):
+        """Count a flat array of valid (finite, non nodata) values."""
+        if values.size == 0:
+            return
+        self._cumulative = None
+        if self.integer and values.dtype.kind in 'iu':
+            info = np.iinfo(values.dtype)
+            # Bins over every value of the type, as for_values lays out
+            # for 8 and 16 bit pixels, never need to grow
+            if not (self.lo <= info.min and info.max <= self.hi):
+                self.cover(values.min(), values.max())
+        else:
+            self.cover(values.min(), values.max())
+        if self.integer and not self.level:
+            index = values.astype(np.int64) - self.lo
+        else:
+            index = self.positions(values).astype(np.int64) - self.first
+            np.minimum(index, self.bins - 1, out=index)
+        self.counts += np.bincount(index, minlength=self.bins)
+
+    def sparse(self):
+        """(position, counts) arrays of the non-empty bins, at the current
+        level."""
+        index = np.flatnonzero(self.counts)
+        return self.first + index, self.counts[index]
+
+    def add_sparse(self, index, counts, level):
+        """Add counts to the bins at the positions index, as returned by
+        sparse() at level.
+
+        Negative counts take values back out, which is how the counts of
+        one tile are replaced without recounting the others.
+        """
+        self._cumulative = None
+        while self.level < level:
+            self.coarsen()
+        shift = self.level - level
+        index = np.asarray(index, dtype=np.int64) >> shift
+        if index.size:
+            while True:
+                first = min(self.first, int(index.min()))
+                last = max(self.first + self.bins - 1, int(index.max()))
+                if last - first + 1 <= self.max_bins:
+                    break
+                self.coarsen()
+                index >>= 1
+                shift += 1
+            self.grow(first, last)
+            if shift:
+                np.add.at(self.counts, index - self.first, counts)
+            else:
+                self.counts[index - self.first] += counts
+
+    def merge(self, other):
+        """Add the counts of other, which must have been created alike."""
+        if (other.integer, other.anchor, other.base) != (self.integer, self.anchor, self.base):
+            raise ValueError("Cannot merge histograms with different bins")
+        if (other.level, other.first, other.bins) == (self.level, self.first, self.bins):
+            self._cumulative = None
+            self.counts += other.counts
+        else:
+            index, counts = other.sparse()
+            self.add_sparse(index, counts, other.level)
+        return self
+
+    def total(self):
+        """Number of values counted."""
+        return int(self.cumulative()[-1])
+
+    def cumulative(self):
+        """Cumulative bin counts, computed once per change."""
+        if self._cumulative is None:
+            self._cumulative = np.cumsum(self.counts)
+        return self._cumulative
+
+    def count_above(self, threshold):
+        """Number of values strictly greater than threshold.
+
+        Runs in O(1) on the cumulative counts. The bin holding threshold is
+        split linearly, which is exact for integer bins of one value.
+        """
+        cumulative = self.cumulative()
+        inside = int(cumulative[-1])
+        if threshold < self.lo:
+            return inside
+        if threshold >= self.hi:
+            return 0
+        width = self.width
+        if self.integer:
+            # The integers up to floor(threshold) are not above it
+            below = int(math.floor(threshold)) + 1 - self.lo
+            index = below // width
+            within = (below - index * width) / float(width)
+        else:
+            position = (threshold - self.lo) / width
+            index = min(int(position), self.bins - 1)
+            within = position - index
+        above = inside - int(cumulative[index]) + (1.0 - within) * self.counts[index]
+        return int(round(above))
+
+    def fraction_above(self, threshold):
+        """Share, between 0 and 1, of values strictly greater than threshold."""
+        total = self.total()
+        if total == 0:
+            return 0.0
+        return self.count_above(threshold) / float(total)
+
+    def edges(self):
+        """Upper edge of every bin, i.e. the threshold that puts the bin
+        and everything below it under the threshold. For integer bins,
+        the last value of the bin."""
+        edges = self.lo + self.width * np.arange(1, self.bins + 1, dtype=np.float64)
+        return edges - 1 if self.integer else edges
+
+    def centers(self):
+        if self.integer:
+            return self.lo + self.width * np.arange(self.bins, dtype=np.float64) + (self.width - 1) / 2.0
+        return self.edges() - self.width / 2.0
+
+    def otsu(self):
+        """Threshold maximizing the between-class variance (Otsu, 1979)."""
+        counts = self.counts.astype(np.float64)
+        below = np.cumsum(counts)
+        total = below[-1]
+        if total == 0:
+            return float(self.lo)
+        weighted = np.cumsum(counts * self.centers())
+        above = total - below
+        with np.errstate(divide='ignore', invalid='ignore'):
+            variance = (weighted[-1] * below - total * weighted) ** 2 / (below * above)
+        variance[~np.isfinite(variance)] = -1
+        return float(self.edges()[int(np.argmax(variance))])
+
+    def triangle(self):
+        """Threshold from the triangle method (Zack et al., 1977).
+
+        A line is drawn from the histogram peak to the far end of its
+        longer tail; the threshold is the bin furthest below that line.
+        """
+        nonzero = np.flatnonzero(self.counts)
+        if nonzero.size == 0:
+            return float(self.lo)
+        peak = int(np.argmax(self.counts))
+        first, last = int(nonzero[0]), int(nonzero[-1])
+        end = first if peak - first > last - peak else last
+        if end == peak:
+            return float(self.edges()[peak])
+        lo, hi = min(peak, end), max(peak, end)
+        index = np.arange(lo, hi + 1)
+        height = float(self.counts[peak])
+        # Height of the peak-to-end line over each bin, minus the bin
+        line = height * (index - end) / float(peak - end)
+        distance = line - self.counts[lo:hi + 1]
+        best = lo + int(np.argmax(distance))
+        # On a left tail the threshold sits below the chosen bin
+        if end < peak:
+            best -= 1
+        if best < 0:
+            return float(self.lo)
+        return float(self.edges()[best])
+
+    def percentile(self, percent):
+        """Value below which percent (0 to 100) of the counted values fall."""
+        total = self.total()
+        if total == 0:
+            return float(self.lo)
+        target = total * min(max(percent, 0.0), 100.0) / 100.0
+        if target <= 0:
+            return float(self.lo)
+        cumulative = self.cumulative()
+        index = int(np.searchsorted(cumulative, target))
+        if index >= self.bins:
+            return float(self.hi)
+        before = cumulative[index - 1] if index > 0 else 0
+        fraction = (target - before) / float(self.counts[index])
+        if self.integer:
+            # The value reached within the bin, from its first
+            return float(self.lo + index * self.width + int(math.ceil(fraction * self.width)) - 1)
+        return float(self.lo + (index + fraction) * self.width)
+
+    def nbytes(self):
+        return self.counts.nbytes
+
+    def to_dict(self):
+        """Serialize to a JSON friendly dict, storing only non-empty bins."""
+        index, counts = self.sparse()
+        return {
+            'lo': self.lo,
+            'hi': self.hi,
+            'bins': self.bins,
+            'anchor': self.anchor,
+            'base': self.base,
+            'level': self.level,
+            'first': self.first,
+            'max_bins': self.max_bins,
+            'integer': self.integer,
+            'sampled': self.sampled,
+            'index': index.tolist(),
+            'counts': counts.tolist(),
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        """Inverse of to_dict."""
+        histogram = cls(0, 0, 1, data['integer'], data['sampled'], data['max_bins'])
+        histogram.anchor = data['anchor']
+        histogram.base = data['base']
+        histogram.level = data['level']
+        histogram.first = data['first']
+        histogram.counts = np.zeros(data['bins'], dtype=np.int64)
+        histogram.counts[np.asarray(data['index'], dtype=np.int64) - histogram.first] = data['counts']
+        return histogram
@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ Threshold
+                                 A QGIS plugin
+ Adds context controls for brightness and contrast
+                              -------------------
+        begin                : 2017-07-05
+        git sha              : $Format:%H$
+        copyright            : (C) 2017 by Ryan Constantino
+        email                : ryan.constantino93@gmail.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+from osgeo import gdal, gdal_array
+from itertools import izip
+import numpy as np
+import os
+import threading
+import profiling
+from threshold_core import DEFAULT_TILE_BUDGET, NODATA_CLASS, classify_tiles, mask_windows
+
+# Side, in pixels, of the internal tiles of the GeoTIFF written
+BLOCK_SIZE = 256
+
+
+class GdalReader(object):
+    """Reads pixel windows of a raster file through GDAL.
+
+    Implements the reader interface of threshold_core. GDAL datasets are
+    not safe to share between threads, so every calling thread opens its
+    own.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        dataset = self.dataset()
+        self.rows = dataset.RasterYSize
+        self.cols = dataset.RasterXSize
+        self.band_count = dataset.RasterCount
+
+    def dataset(self):
+        dataset = getattr(self.local, "dataset", None)
+        if dataset is None:
+            dataset = gdal.Open(self.path, gdal.GA_ReadOnly)
+            if dataset is None:
+                raise IOError("Cannot open raster '{}'".format(self.path))
+            self.local.dataset = dataset
+        return dataset
+
+    def geotransform(self):
+        return self.dataset().GetGeoTransform()
+
+    def wkt(self):
+        return self.dataset().GetProjection()
+
+    def dtype(self, band):
+        return np.dtype(gdal_array.GDALTypeCodeToNumericTypeCode(
+            self.dataset().GetRasterBand(band).DataType))
+
+    def read(self, band, window):
+        """Return (values, nodata) for a (row, col, height, width) window."""
+        row, col, height, width = window
+        raster_band = self.dataset().GetRasterBand(band)
+        return raster_band.ReadAsArray(col, row, width, height), raster_band.GetNoDataValue()
+
+    def read_decimated(self, band, height, width):
+        # GDAL resamples the request, from overviews where it has them
+        raster_band = self.dataset().GetRasterBand(band)
+        values = raster_band.ReadAsArray(0, 0, self.cols, self.rows, width, height)
+        return values, raster_band.GetNoDataValue()
+
+
+def layer_geotransform(layer):
+    """GDAL geotransform of a north up raster layer."""
+    extent = layer.dataProvider().extent()
+    return (extent.xMinimum(), layer.rasterUnitsPerPixelX(), 0,
+            extent.yMaximum(), 0, -layer.rasterUnitsPerPixelY())
+
+
+def export_mask(reader, band, path, geotransform, wkt, breaks, nbits=8,
+                threads=1, tile_budget=DEFAULT_TILE_BUDGET, progress=None, killed=None, colors=None):
+    """Write the classified band to a tiled, compressed GeoTIFF.
+
+    The band is read, classified and written one window at a time, so
+    memory stays bounded by the tile budget. Windows are classified on a
+    pool of threads and written in order by the calling thread.
+
+    The file is written next to path, with a .part suffix, and only takes
+    its final name once complete; an export that is stopped early or fails
+    leaves nothing behind. A byte raster marks nodata pixels with
+    NODATA_CLASS; a 1 bit mask has no room for a third value, so they are
+    marked in its mask band instead, and their pixel value is 0.
+
+    :param reader: Source of pixel windows, see threshold_core.
+    :param band: Band number to classify, starting at 1.
+    :param path: GeoTIFF file to write.
+    :param geotransform: GDAL geotransform of the output.
+    :param wkt: Coordinate reference system of the output, as WKT.
+    :param breaks: Ascending class breakpoints.
+    :param nbits: 8 for a byte raster, 1 for a 1 bit mask (single breakpoint).
+    :param threads: Number of threads classifying windows.
+    :param tile_budget: Bytes of input pixels held per window.
+    :param progress: Optional callback receiving a percentage.
+    :param killed: Optional callback returning True to stop early.
+    :param colors: Optional (r, g, b, a) colour of every class, one more
+        than there are breaks, written as the colour table of the output.
+
+    :returns: False if the export was stopped early, True otherwise.
+    :rtype: bool
+    """
+    if nbits == 1 and len(breaks) != 1:
+        raise ValueError("A 1 bit mask needs exactly one breakpoint")
+    options = ['TILED=YES', 'BLOCKXSIZE={}'.format(BLOCK_SIZE), 'BLOCKYSIZE={}'.format(BLOCK_SIZE),
+               'COMPRESS=DEFLATE', 'BIGTIFF=IF_SAFER']
+    if nbits == 1:
+        options.append('NBITS=1')
+    driver = gdal.GetDriverByName('GTiff')
+    partial = path + '.part'
+    dataset = driver.Create(partial, reader.cols, reader.rows, 1, gdal.GDT_Byte, options)
+    if dataset is None:
+        raise IOError("Cannot create '{}'".format(partial))
+    dataset.SetGeoTransform(geotransform)
+    dataset.SetProjection(wkt)
+    out_band = dataset.GetRasterBand(1)
+    mask_band = None
+    if nbits == 1:
+        dataset.CreateMaskBand(gdal.GMF_PER_DATASET)
+        mask_band = out_band.GetMaskBand()
+    else:
+        out_band.SetNoDataValue(NODATA_CLASS)
+    if colors is not None:
+        table = gdal.ColorTable()
+        for index, color in enumerate(colors):
+            table.SetColorEntry(index, tuple(color))
+        out_band.SetColorTable(table)
+        out_band.SetColorInterpretation(gdal.GCI_PaletteIndex)
+
+    # Windows are whole multiples of the output tiles so that every
+    # internal tile is compressed once, from a single write
+    windows = mask_windows(reader.rows, reader.cols, tile_budget, threads, BLOCK_SIZE,
+                           getattr(reader, 'full_rows', False))
+    tiles = classify_tiles(reader, band, windows, breaks, threads)
+    tracer = profiling.tracer()
+    complete = False
+    try:
+        for completed, (window, classes) in enumerate(izip(windows, tiles), 1):
+            with tracer.span('export.write'):
+                if mask_band is not None:
+                    valid = classes != NODATA_CLASS
+                    classes[~valid] = 0
+                    mask_band.WriteArray(valid.astype(np.uint8) * 255, window[1], window[0])
+                out_band.WriteArray(classes, window[1], window[0])
+            if progress is not None:
+                progress(completed * 100.0 / len(windows))
+            if killed is not None and killed():
+                return False
+        complete = True
+    finally:
+        tiles.close()
+        out_band.FlushCache()
+        out_band = mask_band = None
+        dataset = None
+        if not complete:
+            driver.Delete(partial)
+    # The driver moves the sidecar files, such as an external mask, along
+    if os.path.exists(path):
+        driver.Delete(path)
+    driver.Rename(path, partial)
+    return True
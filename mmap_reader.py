@@ -0,0 +1,303 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ Threshold
+                                 A QGIS plugin
+ Adds context controls for brightness and contrast
+                              -------------------
+        begin                : 2017-07-05
+        git sha              : $Format:%H$
+        copyright            : (C) 2017 by Ryan Constantino
+        email                : ryan.constantino93@gmail.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+import os
+import re
+import struct
+import numpy as np
+
+# ENVI "data type" codes
+ENVI_DTYPES = {
+    1: np.uint8,
+    2: np.int16,
+    3: np.int32,
+    4: np.float32,
+    5: np.float64,
+    12: np.uint16,
+    13: np.uint32,
+    14: np.int64,
+    15: np.uint64,
+}
+# TIFF tags read to locate the pixels of an uncompressed file
+TIFF_WIDTH = 256
+TIFF_LENGTH = 257
+TIFF_BITS_PER_SAMPLE = 258
+TIFF_COMPRESSION = 259
+TIFF_STRIP_OFFSETS = 273
+TIFF_SAMPLES_PER_PIXEL = 277
+TIFF_STRIP_BYTE_COUNTS = 279
+TIFF_PLANAR_CONFIGURATION = 284
+TIFF_TILE_WIDTH = 322
+TIFF_SAMPLE_FORMAT = 339
+TIFF_GDAL_NODATA = 42113
+# TIFF field type: (struct code, size)
+TIFF_TYPES = {
+    1: ('B', 1), 2: ('s', 1), 3: ('H', 2), 4: ('I', 4), 6: ('b', 1), 8: ('h', 2),
+    9: ('i', 4), 11: ('f', 4), 12: ('d', 8), 16: ('Q', 8), 17: ('q', 8),
+}
+# TIFF SampleFormat: NumPy kind
+TIFF_SAMPLE_KINDS = {1: 'u', 2: 'i', 3: 'f'}
+
+
+class MappedReader(object):
+    """Reads pixel windows of an uncompressed raster file by memory mapping.
+
+    Implements the reader interface of threshold_core. Every read maps
+    just the rows of the window and returns a view of the mapping, so no
+    pixel is copied, and the mapping is released as soon as the caller
+    drops the view: a scan holds no more of the file than the tile it is
+    working on, whatever the file size. Windows should span whole rows,
+    as the pages of a row are faulted in together anyway.
+    """
+
+    full_rows = True
+
+    def __init__(self, path, dtype, rows, cols, band_count, offset=0, interleave='bsq', nodata=None):
+        """Constructor.
+
+        :param dtype: Type of the pixels in the file, byte order included.
+        :type dtype: numpy.dtype
+
+        :param offset: Position of the first pixel in the file, in bytes.
+        :type offset: int
+
+        :param interleave: Layout of the bands: 'bsq' (band after band),
+            'bil' (bands interleaved by line) or 'bip' (by pixel).
+        :type interleave: str
+
+        :param nodata: Nodata value of every band, or None.
+        :type nodata: list
+        """
+        self.path = path
+        self.file_dtype = np.dtype(dtype)
+        self.rows = rows
+        self.cols = cols
+        self.band_count = band_count
+        self.offset = offset
+        self.interleave = interleave
+        self.nodata = list(nodata) if nodata is not None else [None] * band_count
+
+    def dtype(self, band):
+        return self.file_dtype
+
+    def map_rows(self, band, row, height):
+        """A (height, cols) view of band over rows [row, row + height)."""
+        itemsize = self.file_dtype.itemsize
+        if self.interleave == 'bsq':
+            start = self.offset + ((band - 1) * self.rows + row) * self.cols * itemsize
+            return np.memmap(self.path, self.file_dtype, 'r', start, (height, self.cols))
+        if self.interleave == 'bil':
+            start = self.offset + row * self.band_count * self.cols * itemsize
+            shape = (height, self.band_count, self.cols)
+            return np.memmap(self.path, self.file_dtype, 'r', start, shape)[:, band - 1, :]
+        start = self.offset + row * self.cols * self.band_count * itemsize
+        shape = (height, self.cols, self.band_count)
+        return np.memmap(self.path, self.file_dtype, 'r', start, shape)[:, :, band - 1]
+
+    def read(self, band, window):
+        """Return (values, nodata) for a (row, col, height, width) window."""
+        row, col, height, width = window
+        return self.map_rows(band, row, height)[:, col:col + width], self.nodata[band - 1]
+
+    def read_decimated(self, band, height, width):
+        row_step = int(np.ceil(self.rows / float(height)))
+        col_step = int(np.ceil(self.cols / float(width)))
+        sampled = range(0, self.rows, row_step)
+        values = np.empty((len(sampled), len(range(0, self.cols, col_step))), self.file_dtype)
+        # One row mapped at a time, so only the sampled rows are ever resident
+        for index, row in enumerate(sampled):
+            values[index] = self.map_rows(band, row, 1)[0, ::col_step]
+        return values, self.nodata[band - 1]
+
+
+def parse_envi_header(path):
+    """Parse an ENVI .hdr file into a dict of lower case keys to strings."""
+    with open(path) as f:
+        text = f.read()
+    if not text.startswith('ENVI'):
+        return None
+    header = {}
+    # Values in braces may span lines
+    for key, value in re.findall(r'^\s*([^=\n]+?)\s*=\s*(\{[^}]*\}|[^\n]*)', text, re.MULTILINE):
+        header[key.lower()] = value.strip().strip('{}').strip()
+    return header
+
+
+def envi_header_path(path):
+    for candidate in (path + '.hdr', os.path.splitext(path)[0] + '.hdr'):
+        if os.path.isfile(candidate):
+            return candidate
+    return None
+
+
+def open_envi(path):
+    """MappedReader over a raw ENVI file, or None if it is not one."""
+    header_path = envi_header_path(path)
+    if header_path is None or os.path.abspath(header_path) == os.path.abspath(path):
+        return None
+    header = parse_envi_header(header_path)
+    if header is None or header.get('file type', 'ENVI Standard') != 'ENVI Standard':
+        return None
+    try:
+        dtype = np.dtype(ENVI_DTYPES[int(header['data type'])])
+        rows, cols = int(header['lines']), int(header['samples'])
+        bands = int(header.get('bands', 1))
+        offset = int(header.get('header offset', 0))
+        interleave = header.get('interleave', 'bsq').lower()
+        big_endian = int(header.get('byte order', 0)) == 1
+    except (KeyError, ValueError):
+        return None
+    if interleave not in ('bsq', 'bil', 'bip'):
+        return None
+    dtype = dtype.newbyteorder('>' if big_endian else '<')
+    if os.path.getsize(path) < offset + rows * cols * bands * dtype.itemsize:
+        return None
+    nodata = None
+    if 'data ignore value' in header:
+        nodata = [float(header['data ignore value'])] * bands
+    return MappedReader(path, dtype, rows, cols, bands, offset, interleave, nodata)
+
+
+def open_npy(path):
+    """MappedReader over a 2D or (bands, rows, cols) .npy file, or None."""
+    with open(path, 'rb') as f:
+        try:
+            version = np.lib.format.read_magic(f)
+        except ValueError:
+            return None
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+        offset = f.tell()
+    if fortran_order or dtype.hasobject or len(shape) not in (2, 3):
+        return None
+    bands, rows, cols = (1,) + shape if len(shape) == 2 else shape
+    return MappedReader(path, dtype, rows, cols, bands, offset)
+
+
+def read_tiff_ifd(f):
+    """Return (byte order, {tag: values}) of the first IFD of a TIFF file."""
+    head = f.read(16)
+    order = {'II': '<', 'MM': '>'}.get(head[:2])
+    if order is None:
+        return None, None
+    magic = struct.unpack(order + 'H', head[2:4])[0]
+    if magic == 42:
+        ifd_offset = struct.unpack(order + 'I', head[4:8])[0]
+        count_format, entry_format, inline = 'H', 'HHII', 4
+    elif magic == 43:
+        ifd_offset = struct.unpack(order + 'Q', head[8:16])[0]
+        count_format, entry_format, inline = 'Q', 'HHQQ', 8
+    else:
+        return None, None
+    f.seek(ifd_offset)
+    count_size = struct.calcsize(count_format)
+    entry_size = struct.calcsize(order + entry_format)
+    count = struct.unpack(order + count_format, f.read(count_size))[0]
+    entries = f.read(count * entry_size)
+    tags = {}
+    for index in range(count):
+        entry = entries[index * entry_size:(index + 1) * entry_size]
+        tag, field_type, length, value = struct.unpack(order + entry_format, entry)
+        if field_type not in TIFF_TYPES:
+            continue
+        code, size = TIFF_TYPES[field_type]
+        if length * size <= inline:
+            data = entry[-inline:][:length * size]
+        else:
+            position = f.tell()
+            f.seek(value)
+            data = f.read(length * size)
+            f.seek(position)
+        if code == 's':
+            tags[tag] = data.rstrip('\0')
+        else:
+            tags[tag] = np.frombuffer(data, np.dtype(order + code)).tolist()
+    return order, tags
+
+
+def open_tiff(path):
+    """MappedReader over an uncompressed, stripped TIFF whose strips are
+    stored back to back, or None for any other TIFF."""
+    with open(path, 'rb') as f:
+        order, tags = read_tiff_ifd(f)
+    if tags is None:
+        return None
+    try:
+        cols, rows = tags[TIFF_WIDTH][0], tags[TIFF_LENGTH][0]
+        offsets, byte_counts = tags[TIFF_STRIP_OFFSETS], tags[TIFF_STRIP_BYTE_COUNTS]
+    except KeyError:
+        return None
+    if tags.get(TIFF_COMPRESSION, [1])[0] != 1 or TIFF_TILE_WIDTH in tags:
+        return None
+    bands = tags.get(TIFF_SAMPLES_PER_PIXEL, [1])[0]
+    bits = set(tags.get(TIFF_BITS_PER_SAMPLE, [1]))
+    formats = set(tags.get(TIFF_SAMPLE_FORMAT, [1]))
+    if len(bits) != 1 or len(formats) != 1:
+        return None
+    bits, kind = bits.pop(), TIFF_SAMPLE_KINDS.get(formats.pop())
+    if kind is None or bits not in (8, 16, 32, 64) or (kind == 'f' and bits < 32):
+        return None
+    dtype = np.dtype('{}{}{}'.format(order, kind, bits // 8))
+    # Strips must form one contiguous run of exactly the expected pixels
+    if any(offsets[i] + byte_counts[i] != offsets[i + 1] for i in range(len(offsets) - 1)):
+        return None
+    if sum(byte_counts) != rows * cols * bands * dtype.itemsize:
+        return None
+    planar = tags.get(TIFF_PLANAR_CONFIGURATION, [1])[0]
+    interleave = 'bsq' if bands == 1 or planar == 2 else 'bip'
+    nodata = None
+    if TIFF_GDAL_NODATA in tags:
+        try:
+            nodata = [float(tags[TIFF_GDAL_NODATA])] * bands
+        except ValueError:
+            pass
+    return MappedReader(path, dtype, rows, cols, bands, offsets[0], interleave, nodata)
+
+
+def open_mapped(path, nodata=None):
+    """Return a MappedReader for path, or None when it cannot be mapped.
+
+    Local .npy files, raw ENVI files and uncompressed stripped GeoTIFFs
+    are mapped; anything else, compressed or remote, returns None and
+    should be read through the provider or GDAL instead.
+
+    :param nodata: Nodata value of every band as known to the caller, for
+        example from the data provider; overrides what the file says.
+    :type nodata: list
+    """
+    if not isinstance(path, basestring) or not os.path.isfile(path):
+        return None
+    extension = os.path.splitext(path)[1].lower()
+    try:
+        if extension == '.npy':
+            reader = open_npy(path)
+        elif extension in ('.tif', '.tiff'):
+            reader = open_tiff(path)
+        else:
+            reader = open_envi(path)
+    except (IOError, OSError, ValueError, struct.error):
+        return None
+    if reader is not None and nodata is not None:
+        reader.nodata = list(nodata)
+    return reader
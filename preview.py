@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ Threshold
+                                 A QGIS plugin
+ Adds context controls for brightness and contrast
+                              -------------------
+        begin                : 2017-07-05
+        git sha              : $Format:%H$
+        copyright            : (C) 2017 by Ryan Constantino
+        email                : ryan.constantino93@gmail.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+from qgis.core import *
+from qgis.gui import QgsMapCanvasItem
+from PyQt4.QtCore import QRectF
+from PyQt4.QtGui import QImage
+import math
+import time
+import profiling
+from Worker import block_to_array
+from threshold_core import class_lut, quantize, valid_mask
+
+# Default resolution of the preview, as a fraction of the canvas size
+DEFAULT_PREVIEW_SCALE = 0.25
+# Bounds of the preview resolution when it adapts to measured draw times
+MIN_PREVIEW_SCALE = 0.05
+MAX_PREVIEW_SCALE = 1.0
+# Time, in ms, a preview frame should take to draw for smooth dragging
+FRAME_BUDGET = 30.0
+
+
+class PreviewItem(QgsMapCanvasItem):
+    """Canvas item that draws a pre-rendered image over the whole canvas."""
+
+    def __init__(self, canvas):
+        QgsMapCanvasItem.__init__(self, canvas)
+        self.canvas = canvas
+        self.image = None
+        self.setZValue(100)
+
+    def set_image(self, image):
+        self.image = image
+        self.setRect(self.canvas.extent())
+        self.update()
+
+    def paint(self, painter):
+        if self.image is not None:
+            painter.drawImage(QRectF(0, 0, self.canvas.width(), self.canvas.height()), self.image)
+
+
+class Preview(object):
+    """Low resolution stand-in for the layer while the slider is dragged.
+
+    The band is read once per canvas extent at a fraction of the canvas
+    resolution and quantized into an index raster along the precision
+    steps. A new threshold then only rewrites the small colour lookup
+    table, which is applied to the index raster and drawn as a canvas
+    item. Nothing goes through the layer's renderer until the full quality
+    render replaces the preview.
+    """
+
+    def __init__(self, canvas, scale=DEFAULT_PREVIEW_SCALE):
+        self.canvas = canvas
+        self.scale = scale
+        # Smoothed draw time of a preview frame, in ms
+        self.frame_time = None
+        self.item = None
+        self.key = None
+        self.index = None
+        self.levels = None
+        self.lut_key = None
+        self.lut = None
+
+    def prepare(self, layer, band, lo, hi, precision):
+        """Read and quantize the decimated buffer for the visible extent.
+
+        :returns: False when no preview can be shown, for example when the
+            layer is drawn in another CRS than its own.
+        :rtype: bool
+        """
+        if not lo <= hi:
+            return False
+        settings = self.canvas.mapSettings()
+        if settings.hasCrsTransformEnabled() and settings.destinationCrs() != layer.crs():
+            return False
+        extent = self.canvas.extent()
+        width = max(int(self.canvas.width() * self.scale), 1)
+        height = max(int(self.canvas.height() * self.scale), 1)
+        key = (layer.id(), band, extent.toString(), width, height, lo, hi, precision)
+        if key == self.key:
+            return True
+        tracer = profiling.tracer()
+        with tracer.span('preview.read'):
+            block = layer.dataProvider().block(band, extent, width, height)
+            values = block_to_array(block, height, width)
+        with tracer.span('preview.quantize'):
+            valid = valid_mask(values, block.noDataValue() if block.hasNoDataValue() else None)
+            self.index, self.levels = quantize(values, valid, lo, hi, precision)
+        self.key = key
+        self.lut_key = None
+        return True
+
+    def show(self, breaks, base):
+        """Draw the index raster through the lookup table for breaks.
+
+        :param breaks: Ascending (value, QColor) class breakpoints.
+        :type breaks: list
+
+        :param base: Colour of the values above the last breakpoint.
+        :type base: QColor
+        """
+        if self.index is None:
+            return
+        started = time.time()
+        values = [value for value, _ in breaks]
+        colors = [color.rgba() for _, color in breaks] + [base.rgba()]
+        lut_key = (tuple(values), tuple(colors))
+        if lut_key != self.lut_key:
+            self.lut = class_lut(self.levels, values, colors)
+            self.lut_key = lut_key
+        pixels = self.lut.take(self.index)
+        height, width = pixels.shape
+        image = QImage(pixels.tobytes(), width, height, QImage.Format_ARGB32).copy()
+        if self.item is None:
+            self.item = PreviewItem(self.canvas)
+        self.item.set_image(image)
+        self.item.show()
+        profiling.tracer().record('preview.show', started)
+        self.adapt((time.time() - started) * 1000)
+
+    def adapt(self, frame_time):
+        """Resize the next preview buffer so a frame fits FRAME_BUDGET.
+
+        Draw time grows with the pixel count, i.e. with the square of the
+        scale, and the new scale applies from the next prepare().
+        """
+        if self.frame_time is None:
+            self.frame_time = frame_time
+        else:
+            self.frame_time += 0.3 * (frame_time - self.frame_time)
+        if self.frame_time > 0:
+            scale = self.scale * math.sqrt(FRAME_BUDGET / self.frame_time)
+            self.scale = min(max(scale, MIN_PREVIEW_SCALE), MAX_PREVIEW_SCALE)
+
+    def hide(self):
+        if self.item is not None:
+            self.item.hide()
+
+    def remove(self):
+        """Take the canvas item off the canvas and forget the buffer."""
+        if self.item is not None:
+            self.canvas.scene().removeItem(self.item)
+            self.item = None
+        self.key = self.index = self.levels = self.lut = self.lut_key = None
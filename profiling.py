@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ Threshold
+                                 A QGIS plugin
+ Adds context controls for brightness and contrast
+                              -------------------
+        begin                : 2017-07-05
+        git sha              : $Format:%H$
+        copyright            : (C) 2017 by Ryan Constantino
+        email                : ryan.constantino93@gmail.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+import json
+import os
+import threading
+import time
+
+# Most events kept for the trace file; the summary counts every event
+MAX_EVENTS = 100000
+
+
+class NullSpan(object):
+    """Context manager that does nothing, shared by every disabled span."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+NULL_SPAN = NullSpan()
+
+
+class NullTracer(object):
+    """Tracer used when tracing is off: every call is a no-op."""
+
+    enabled = False
+
+    def span(self, name):
+        return NULL_SPAN
+
+    def record(self, name, start, end=None):
+        pass
+
+
+class Span(object):
+
+    def __init__(self, tracer, name):
+        self.tracer = tracer
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.tracer.record(self.name, self.start)
+        return False
+
+
+class Tracer(object):
+    """Records how long named stages take, from any thread.
+
+    Stages are timed with span(), or with record() for stages that start
+    and end in different calls, such as a canvas repaint. The events can
+    be summarized per stage or written as a Chrome trace, which
+    chrome://tracing and Perfetto display as a timeline per thread.
+    """
+
+    enabled = True
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.origin = time.time()
+        self.events = []
+        self.dropped = 0
+        # name: [count, total, max], in seconds
+        self.stages = {}
+
+    def span(self, name):
+        """Time the body of a with statement as stage name."""
+        return Span(self, name)
+
+    def record(self, name, start, end=None):
+        """Record stage name as running from start to end (default: now)."""
+        if end is None:
+            end = time.time()
+        duration = end - start
+        with self.lock:
+            stage = self.stages.get(name)
+            if stage is None:
+                self.stages[name] = [1, duration, duration]
+            else:
+                stage[0] += 1
+                stage[1] += duration
+                stage[2] = max(stage[2], duration)
+            if len(self.events) < MAX_EVENTS:
+                self.events.append((name, start, duration, threading.current_thread().ident))
+            else:
+                self.dropped += 1
+
+    def clear(self):
+        with self.lock:
+            self.origin = time.time()
+            self.events = []
+            self.dropped = 0
+            self.stages = {}
+
+    def summary(self):
+        """Per stage (name, count, total ms, mean ms, max ms), longest total first."""
+        with self.lock:
+            stages = [(name, count, total * 1000, total * 1000 / count, longest * 1000)
+                      for name, (count, total, longest) in self.stages.items()]
+        return sorted(stages, key=lambda stage: -stage[2])
+
+    def format_summary(self):
+        lines = ["{:<24} {:>7} {:>11} {:>9} {:>9}".format('stage', 'count', 'total ms', 'mean ms', 'max ms')]
+        for name, count, total, mean, longest in self.summary():
+            lines.append("{:<24} {:>7} {:>11.1f} {:>9.2f} {:>9.2f}".format(name, count, total, mean, longest))
+        if self.dropped:
+            lines.append("({} events left out of the trace file)".format(self.dropped))
+        return '\n'.join(lines)
+
+    def chrome_trace(self):
+        """The events in the Chrome trace event format, as a dict."""
+        pid = os.getpid()
+        with self.lock:
+            events = list(self.events)
+        return {
+            'displayTimeUnit': 'ms',
+            'traceEvents': [{
+                'name': name,
+                'ph': 'X',
+                'ts': (start - self.origin) * 1e6,
+                'dur': duration * 1e6,
+                'pid': pid,
+                'tid': thread,
+            } for name, start, duration, thread in events],
+        }
+
+    def write(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.chrome_trace(), f)
+
+
+_tracer = NullTracer()
+
+
+def tracer():
+    """The current tracer; a NullTracer unless tracing was enabled."""
+    return _tracer
+
+
+def set_enabled(enabled):
+    """Turn tracing on or off.
+
+    Turning it on from off starts a fresh Tracer; if tracing is already on
+    the current Tracer and its events are kept. Turning it off drops them.
+    """
+    global _tracer
+    if enabled and not _tracer.enabled:
+        _tracer = Tracer()
+    elif not enabled:
+        _tracer = NullTracer()
+    return _tracer
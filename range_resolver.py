@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ Threshold
+                                 A QGIS plugin
+ Adds context controls for brightness and contrast
+                              -------------------
+        begin                : 2017-07-05
+        git sha              : $Format:%H$
+        copyright            : (C) 2017 by Ryan Constantino
+        email                : ryan.constantino93@gmail.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+from qgis.core import *
+import numpy as np
+from Worker import ProviderReader
+from threshold_core import estimate_range
+from histogram import Histogram, DEFAULT_BINS
+from stats_cache import LayerStats, TIER_STORED, TIER_OVERVIEW
+
+RANGE_STATS = QgsRasterBandStats.Min | QgsRasterBandStats.Max
+# Number of pixels the provider samples for an approximate histogram
+HISTOGRAM_SAMPLE_SIZE = 250000
+
+
+def sampled_histogram(provider, band, stats):
+    """Ask the provider for an approximate histogram over the range of stats."""
+    qgs_histogram = provider.histogram(band, DEFAULT_BINS, stats.minimum, stats.maximum,
+                                       QgsRectangle(), HISTOGRAM_SAMPLE_SIZE)
+    histogram = Histogram(qgs_histogram.minimum, qgs_histogram.maximum,
+                          qgs_histogram.binCount, sampled=True)
+    histogram.counts[:] = np.asarray(qgs_histogram.histogramVector, dtype=np.int64)
+    return histogram
+
+
+def stored_stats(layer, band):
+    """Return statistics the provider already holds for band, or None.
+
+    For GDAL sources these are the statistics stored in the file or its
+    .aux.xml sidecar; nothing is computed when there are none. They are
+    always marked as sampled: the GDAL versions this plugin runs with do
+    not record whether statistics came from every pixel, and tools often
+    store approximate ones. A full scan makes the range exact.
+    """
+    provider = layer.dataProvider()
+    if not provider.hasStatistics(band, RANGE_STATS):
+        return None
+    stats = provider.bandStatistics(band, RANGE_STATS)
+    if stats.minimumValue > stats.maximumValue:
+        return None
+    return LayerStats(stats.minimumValue, stats.maximumValue, False, TIER_STORED)
+
+
+def overview_stats(layer, band):
+    """Estimate the range from the layer's overviews, or None if it has none."""
+    provider = layer.dataProvider()
+    if not any(pyramid.exists for pyramid in provider.buildPyramidList()):
+        return None
+    _min, _max = estimate_range(ProviderReader(layer, clone=False), band)
+    if _min > _max:
+        return None
+    return LayerStats(_min, _max, False, TIER_OVERVIEW)
+
+
+def resolve_range(layer, band):
+    """Resolve the range of band without scanning every pixel.
+
+    Tries the provider's stored statistics first, then an estimate read
+    from the overviews. Returns None when neither is available, in which
+    case the caller falls back to a full scan with Worker.
+
+    :param layer: Layer to resolve the range for.
+    :type layer: QgsRasterLayer
+
+    :param band: Band number, starting at 1.
+    :type band: int
+
+    :returns: The statistics, tagged with the tier that produced them.
+    :rtype: LayerStats
+    """
+    provider = layer.dataProvider()
+    stats = stored_stats(layer, band) or overview_stats(layer, band)
+    if stats is not None:
+        stats.histogram = sampled_histogram(provider, band, stats)
+    return stats
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ Threshold
+                                 A QGIS plugin
+ Adds context controls for brightness and contrast
+                              -------------------
+        begin                : 2017-07-05
+        git sha              : $Format:%H$
+        copyright            : (C) 2017 by Ryan Constantino
+        email                : ryan.constantino93@gmail.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+from PyQt4.QtCore import QObject, QTimer, pyqtSignal
+import time
+import profiling
+
+# Longest time, in ms, to wait for a render to report back before the
+# scheduler stops treating it as in flight
+RENDER_TIMEOUT = 5000
+# Upper bound, in ms, of the debounce interval derived from measured latency
+MAX_DEBOUNCE = 500
+
+
+class LatencyTracker(object):
+    """Exponentially weighted moving average of a duration, per key."""
+
+    def __init__(self, weight=0.3):
+        """Constructor.
+
+        :param weight: Weight of a new sample against the running average.
+        :type weight: float
+        """
+        self.weight = weight
+        self.values = {}
+
+    def record(self, key, duration):
+        previous = self.values.get(key)
+        if previous is None:
+            self.values[key] = duration
+        else:
+            self.values[key] = previous + self.weight * (duration - previous)
+
+    def get(self, key, default=None):
+        return self.values.get(key, default)
+
+
+class RenderScheduler(QObject):
+    """Coalesce render requests so that only the newest state is drawn.
+
+    Requests only mark the state as dirty and (re)start a debounce timer;
+    the render callback reads whatever the state is when the timer fires,
+    so intermediate values are skipped but the last one never is. A
+    request arriving while a render is in flight waits for it to finish
+    and is then drawn, so renders never pile up behind each other. A
+    render that has been running for longer than the debounce interval
+    is drawing a long out of date state, and is cancelled instead when
+    the cancel callback can stop it; the render started in its place is
+    always left to finish, so a continuous drag still lands frames.
+
+    The time from starting a render to render_finished() is measured per
+    key (the layer being drawn), and the debounce interval follows it:
+    there is no point in starting renders faster than they complete.
+    """
+
+    # key, measured repaint time in ms
+    latencyMeasured = pyqtSignal(str, float)
+
+    def __init__(self, render, cancel=None, parent=None):
+        """Constructor.
+
+        :param render: Callback drawing the current state. It returns True
+            when it started an asynchronous render that will be reported
+            through render_finished(), False when nothing is in flight.
+        :type render: function
+
+        :param cancel: Callback stopping the in-flight render, if any. It
+            returns True when it stopped it, False when it could not.
+        :type cancel: function
+        """
+        QObject.__init__(self, parent)
+        self.render = render
+        self.cancel = cancel
+        self.pending = False
+        self.in_flight = False
+        # Number of renders started, and of those cancelled as superseded
+        self.generation = 0
+        self.cancelled = 0
+        # True while the render started in place of a cancelled one runs
+        self.replacing = False
+        self.key = None
+        self.started = None
+        self.repaint = LatencyTracker()
+
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.timeout.connect(self.flush)
+
+        self.watchdog = QTimer(self)
+        self.watchdog.setSingleShot(True)
+        self.watchdog.timeout.connect(self.on_timeout)
+
+    def debounce(self, delay):
+        """Debounce interval for the current key: at least delay, and half
+        the measured repaint time so slow layers are not flooded."""
+        latency = self.repaint.get(self.key)
+        if latency is None:
+            return delay
+        return int(max(delay, min(latency / 2.0, MAX_DEBOUNCE)))
+
+    def schedule(self, delay):
+        """Ask for a render of the current state after delay ms of quiet."""
+        self.pending = True
+        if self.stale(delay) and self.cancel():
+            self.cancelled += 1
+            self.watchdog.stop()
+            self.in_flight = False
+            self.replacing = True
+        if not self.in_flight:
+            self.timer.start(self.debounce(delay))
+
+    def stale(self, delay):
+        """Whether the in-flight render has run long enough to be cancelled."""
+        if not self.in_flight or self.cancel is None or self.replacing:
+            return False
+        return (time.time() - self.started) * 1000 > self.debounce(delay)
+
+    def flush(self):
+        """Render the current state now, unless a render is in flight."""
+        if self.in_flight or not self.pending:
+            return
+        self.pending = False
+        self.started = time.time()
+        self.generation += 1
+        self.in_flight = bool(self.render())
+        if self.in_flight:
+            self.watchdog.start(RENDER_TIMEOUT)
+
+    def render_finished(self):
+        """Mark the in-flight render as done and draw what is pending."""
+        if self.in_flight and self.key is not None:
+            profiling.tracer().record('repaint', self.started)
+            latency = (time.time() - self.started) * 1000
+            self.repaint.record(self.key, latency)
+            self.latencyMeasured.emit(self.key, self.repaint.get(self.key))
+        self.finish()
+
+    def on_timeout(self):
+        # The render never reported back, do not count it as a measurement
+        self.finish()
+
+    def finish(self):
+        self.watchdog.stop()
+        self.in_flight = False
+        self.replacing = False
+        if self.pending:
+            self.timer.start(0)
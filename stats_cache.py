@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ Threshold
+                                 A QGIS plugin
+ Adds context controls for brightness and contrast
+                              -------------------
+        begin                : 2017-07-05
+        git sha              : $Format:%H$
+        copyright            : (C) 2017 by Ryan Constantino
+        email                : ryan.constantino93@gmail.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+from collections import OrderedDict
+import hashlib
+import json
+import os
+import sys
+from histogram import Histogram
+
+# Default memory limit, in bytes, for the in-memory statistics cache
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+# Version of the DiskStatsCache documents; bumped whenever LayerStats or
+# Histogram serialize differently
+CACHE_FORMAT = 2
+
+# Where a range came from, cheapest first
+TIER_STORED = 'stored statistics'
+TIER_OVERVIEW = 'overview estimate'
+TIER_SCAN = 'full scan'
+
+
+class LayerStats(object):
+    """Statistics computed for one band of a raster layer."""
+
+    def __init__(self, minimum, maximum, exact=False, tier=TIER_SCAN, histogram=None, tiles=None):
+        """Constructor.
+
+        :param minimum: Smallest valid pixel value.
+        :type minimum: float
+
+        :param maximum: Largest valid pixel value.
+        :type maximum: float
+
+        :param exact: True when every pixel was scanned, False when the
+            range comes from a sample.
+        :type exact: bool
+
+        :param tier: Which of the TIER_* sources produced the range.
+        :type tier: str
+
+        :param histogram: Histogram of the band, if one was built.
+        :type histogram: Histogram
+
+        :param tiles: Statistics per scan window, sharing histogram, so
+            that regions rewritten in place can be rescanned alone. They
+            are kept in memory only, never written to disk.
+        :type tiles: TileStats
+        """
+        self.minimum = minimum
+        self.maximum = maximum
+        self.exact = exact
+        self.tier = tier
+        self.histogram = histogram
+        self.tiles = tiles
+
+    def to_dict(self):
+        """Serialize to a JSON friendly dict."""
+        return {
+            'min': self.minimum,
+            'max': self.maximum,
+            'mode': 'exact' if self.exact else 'sampled',
+            'tier': self.tier,
+            'histogram': self.histogram.to_dict() if self.histogram else None,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        """Inverse of to_dict."""
+        histogram = data.get('histogram')
+        histogram = Histogram.from_dict(histogram) if histogram else None
+        return cls(data['min'], data['max'], data['mode'] == 'exact',
+                   data.get('tier', TIER_SCAN), histogram)
+
+    def nbytes(self):
+        """Approximate memory held by these statistics, in bytes."""
+        size = sys.getsizeof(self) + 2 * sys.getsizeof(self.minimum)
+        if self.histogram is not None:
+            size += self.histogram.nbytes()
+        if self.tiles is not None:
+            size += self.tiles.nbytes()
+        return size
+
+
+class StatsCache(object):
+    """In-memory LRU cache of LayerStats keyed by layer, source and band.
+
+    Entries are evicted least recently used first once the total size of
+    the cached statistics goes over max_bytes.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, layer_id, source, band):
+        """Return the cached LayerStats, or None on a miss.
+
+        A hit marks the entry as most recently used.
+        """
+        key = (layer_id, source, band)
+        stats = self.entries.pop(key, None)
+        if stats is not None:
+            self.entries[key] = stats
+        return stats
+
+    def put(self, layer_id, source, band, stats):
+        """Store stats, evicting old entries until the cache fits again."""
+        key = (layer_id, source, band)
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.size -= old.nbytes()
+        self.entries[key] = stats
+        self.size += stats.nbytes()
+        while self.size > self.max_bytes and len(self.entries) > 1:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= evicted.nbytes()
+
+    def invalidate(self, layer_id):
+        """Drop every entry that belongs to layer_id."""
+        for key in [key for key in self.entries if key[0] == layer_id]:
+            self.size -= self.entries.pop(key).nbytes()
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+
+
+class DiskStatsCache(object):
+    """Persistent statistics cache for file based rasters.
+
+    Each raster file gets one JSON document in directory, named after a
+    hash of its path. The document records the size and modification time
+    the statistics were computed for, so an entry for a file that has
+    changed since is detected as stale and removed on lookup. So is one
+    written in another format than CACHE_FORMAT.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def entry_path(self, path):
+        digest = hashlib.sha1(os.path.abspath(path).encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, digest + '.json')
+
+    @staticmethod
+    def identity(path):
+        """Return (size, mtime) of path, or None if it is not a local file."""
+        try:
+            if not os.path.isfile(path):
+                return None
+            info = os.stat(path)
+        except (OSError, TypeError, ValueError):
+            return None
+        return (info.st_size, info.st_mtime)
+
+    def load(self, path):
+        """Read the document for path, dropping it when it is stale."""
+        identity = self.identity(path)
+        if identity is None:
+            return None
+        entry_path = self.entry_path(path)
+        try:
+            with open(entry_path) as f:
+                document = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+        if (document.get('version') != CACHE_FORMAT
+                or document.get('path') != os.path.abspath(path)
+                or document.get('size') != identity[0]
+                or document.get('mtime') != identity[1]):
+            self.remove(path)
+            return None
+        return document
+
+    def get(self, path, band):
+        """Return the LayerStats stored for band of path, or None."""
+        document = self.load(path)
+        if document is None:
+            return None
+        data = document['bands'].get(str(band))
+        if data is None:
+            return None
+        return LayerStats.from_dict(data)
+
+    def put(self, path, band, stats):
+        """Store stats for band of path. Failures to write are ignored."""
+        identity = self.identity(path)
+        if identity is None:
+            return
+        document = self.load(path) or {
+            'version': CACHE_FORMAT,
+            'path': os.path.abspath(path),
+            'size': identity[0],
+            'mtime': identity[1],
+            'bands': {},
+        }
+        document['bands'][str(band)] = stats.to_dict()
+        entry_path = self.entry_path(path)
+        tmp_path = entry_path + '.tmp'
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            with open(tmp_path, 'w') as f:
+                json.dump(document, f)
+            if os.path.exists(entry_path):
+                os.remove(entry_path)
+            os.rename(tmp_path, entry_path)
+        except (IOError, OSError):
+            pass
+
+    def remove(self, path):
+        try:
+            os.remove(self.entry_path(path))
+        except OSError:
+            pass
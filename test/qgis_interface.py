@@ -170,6 +170,28 @@ class QgisInterface(QObject):
         """
         pass
 
+    def addPluginToMenu(self, name, action):
+        """Add an action to the plugin menu.
+
+        :param name: Name of the plugin menu.
+        :type name: str
+
+        :param action: Action to add to the menu.
+        :type action: QAction
+        """
+        pass
+
+    def removePluginMenu(self, name, action):
+        """Remove an action from the plugin menu.
+
+        :param name: Name of the plugin menu.
+        :type name: str
+
+        :param action: Action to remove from the menu.
+        :type action: QAction
+        """
+        pass
+
     def addToolBar(self, name):
         """Add toolbar with specified name.
 
@@ -0,0 +1,134 @@
+# coding=utf-8
+"""Histogram test.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+     it under the terms of the GNU General Public License as published by
+     the Free Software Foundation; either version 2 of the License, or
+     (at your option) any later version.
+
+"""
+
+__author__ = 'ryan.constantino93@gmail.com'
+__date__ = '2017-07-05'
+__copyright__ = 'Copyright 2017, Ryan Constantino'
+
+import unittest
+
+import numpy as np
+
+from histogram import Histogram
+
+
+class HistogramTest(unittest.TestCase):
+    """Test histogram construction and threshold queries."""
+
+    def test_integer_exact(self):
+        """Test byte rasters get an exact per-value histogram."""
+        values = np.arange(256, dtype=np.uint8).repeat(2)
+        histogram = Histogram.for_values(values.dtype, 0, 10)
+        histogram.add(values)
+        self.assertTrue(histogram.integer)
+        self.assertEqual(histogram.total(), 512)
+        self.assertEqual(histogram.count_above(99.5), 2 * 156)
+        self.assertEqual(histogram.count_above(255), 0)
+        self.assertEqual(histogram.count_above(-1), 512)
+
+    def test_float_counts(self):
+        """Test float counts above a threshold, including outliers."""
+        values = np.linspace(0.0, 1.0, 10001)
+        histogram = Histogram(0.0, 1.0, bins=100)
+        histogram.add(values)
+        histogram.add(np.array([5.0, -5.0]))
+        self.assertEqual(histogram.total(), 10003)
+        self.assertTrue(histogram.lo <= -5.0 and histogram.hi > 5.0)
+        self.assertAlmostEqual(histogram.count_above(0.25), 7501, delta=1)
+        self.assertEqual(histogram.count_above(2.0), 1)
+        self.assertEqual(histogram.count_above(-10.0), 10003)
+
+    def test_count_above_against_values(self):
+        """Test counts are exact for integer bins and only estimated,
+        within the threshold's bin, for float ones."""
+        random = np.random.RandomState(0)
+        values = random.randint(0, 1000, 250000).astype(np.int32)
+        histogram = Histogram.for_values(values.dtype, 0, 999)
+        histogram.add(values)
+        self.assertTrue(histogram.exact)
+        for threshold in (-1, 0, 0.5, 250, 998.5, 999):
+            self.assertEqual(histogram.count_above(threshold), (values > threshold).sum())
+        # A spike at the minimum, where the float bins are anchored
+        values = random.rand(250000).astype(np.float32)
+        values[:75000] = 0.0
+        histogram = Histogram.for_values(values.dtype, 0.0, float(values.max()))
+        histogram.add(values)
+        self.assertFalse(histogram.exact)
+        for threshold in (0.0, 0.05, 0.5, 0.999):
+            index = min(int((threshold - histogram.lo) / histogram.width), histogram.bins - 1)
+            self.assertTrue(abs(histogram.count_above(threshold) - (values > threshold).sum())
+                            <= histogram.counts[index])
+
+    def test_bins_grow_past_estimate(self):
+        """Test values past the estimated range are binned, not lumped."""
+        histogram = Histogram(0.0, 1.0, bins=100)
+        histogram.add(np.linspace(0.0, 1.0, 1001))
+        histogram.add(np.array([3.0, 4.0, 4.5]))
+        self.assertTrue(histogram.hi >= 4.5)
+        self.assertEqual(histogram.count_above(2.0), 3)
+        self.assertEqual(histogram.count_above(3.5), 2)
+        self.assertEqual(histogram.count_above(4.25), 1)
+        # Far outliers coarsen the bins rather than grow them without end
+        histogram.add(np.array([1e9]))
+        self.assertTrue(histogram.bins <= histogram.max_bins)
+        self.assertEqual(histogram.total(), 1005)
+        self.assertEqual(histogram.count_above(1e8), 1)
+
+    def test_wide_integer_bins(self):
+        """Test 32 bit integers get integer bins over their range."""
+        histogram = Histogram.for_values(np.int32, 0, 10)
+        histogram.add(np.arange(11, dtype=np.int32))
+        self.assertTrue(histogram.integer)
+        self.assertEqual(histogram.count_above(4.5), 6)
+        histogram.add(np.array([100000], dtype=np.int32))
+        self.assertEqual(histogram.total(), 12)
+        self.assertEqual(histogram.count_above(50000), 1)
+        # Bins now hold several values each; percentiles land in the right one
+        self.assertTrue(histogram.width > 1)
+        self.assertTrue(100000 <= histogram.percentile(100) < 100000 + histogram.width)
+
+    def test_otsu_bimodal(self):
+        """Test Otsu splits two well separated modes."""
+        histogram = Histogram.for_values(np.uint8, 0, 255)
+        histogram.add(np.concatenate([np.full(1000, 50, np.uint8), np.full(1000, 200, np.uint8)]))
+        threshold = histogram.otsu()
+        self.assertTrue(50 <= threshold < 200)
+
+    def test_triangle_long_tail(self):
+        """Test the triangle threshold lands in the tail, off the peak."""
+        histogram = Histogram(0.0, 100.0, bins=100)
+        values = np.concatenate([np.full(5000, 10.5), np.linspace(11.0, 90.0, 800)])
+        histogram.add(values)
+        threshold = histogram.triangle()
+        self.assertTrue(11.0 <= threshold < 90.0)
+
+    def test_percentile(self):
+        """Test percentiles interpolate across the cumulative counts."""
+        histogram = Histogram(0.0, 1.0, bins=1000)
+        histogram.add(np.linspace(0.0, 1.0, 100001))
+        self.assertAlmostEqual(histogram.percentile(95), 0.95, places=2)
+        self.assertEqual(histogram.percentile(0), 0.0)
+        self.assertEqual(histogram.percentile(100), 1.0)
+
+    def test_merge_and_round_trip(self):
+        """Test merged and serialized histograms keep their counts."""
+        a = Histogram(0.0, 10.0, bins=10)
+        b = a.empty_like()
+        a.add(np.array([1.0, 2.0, 3.0]))
+        b.add(np.array([7.0, 8.0, 11.0]))
+        a.merge(b)
+        restored = Histogram.from_dict(a.to_dict())
+        self.assertEqual(restored.total(), 6)
+        self.assertEqual(restored.count_above(5.0), 3)
+        self.assertEqual(restored.count_above(10.5), 1)
+        self.assertRaises(ValueError, a.merge, Histogram(0.0, 5.0, bins=10))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,134 @@
+# coding=utf-8
+"""Memory mapped reader test.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+     it under the terms of the GNU General Public License as published by
+     the Free Software Foundation; either version 2 of the License, or
+     (at your option) any later version.
+
+"""
+
+__author__ = 'ryan.constantino93@gmail.com'
+__date__ = '2017-07-05'
+__copyright__ = 'Copyright 2017, Ryan Constantino'
+
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+
+import numpy as np
+
+from mmap_reader import open_mapped
+from threshold_core import RangeScan
+
+
+def write_tiff(path, values, order='<', nodata=None, compression=1, rows_per_strip=3):
+    """Write a single band, stripped TIFF with the pixels right after the header."""
+    rows, cols = values.shape
+    data = values.astype(values.dtype.newbyteorder(order)).tobytes()
+    strip = rows_per_strip * cols * values.dtype.itemsize
+    offsets = [8 + start for start in range(0, len(data), strip)]
+    counts = [min(strip, len(data) - start) for start in range(0, len(data), strip)]
+    sample_format = {'u': 1, 'i': 2, 'f': 3}[values.dtype.kind]
+    entries = [
+        (256, 4, [cols]), (257, 4, [rows]), (258, 3, [values.dtype.itemsize * 8]),
+        (259, 3, [compression]), (262, 3, [1]), (273, 4, offsets), (277, 3, [1]),
+        (278, 4, [rows_per_strip]), (279, 4, counts), (339, 3, [sample_format])]
+    if nodata is not None:
+        entries.append((42113, 2, str(nodata) + '\0'))
+    ifd_offset = 8 + len(data)
+    extra_offset = ifd_offset + 2 + 12 * len(entries) + 4
+    ifd, extra = '', ''
+    for tag, field_type, value in entries:
+        if field_type == 2:
+            payload = value
+        else:
+            payload = struct.pack(order + {3: 'H', 4: 'I'}[field_type] * len(value), *value)
+        if len(payload) <= 4:
+            field = payload.ljust(4, '\0')
+        else:
+            field = struct.pack(order + 'I', extra_offset + len(extra))
+            extra += payload
+        ifd += struct.pack(order + 'HHI', tag, field_type, len(value)) + field
+    with open(path, 'wb') as f:
+        f.write(('II' if order == '<' else 'MM') + struct.pack(order + 'HI', 42, ifd_offset))
+        f.write(data)
+        f.write(struct.pack(order + 'H', len(entries)) + ifd + struct.pack(order + 'I', 0) + extra)
+
+
+class MappedReaderTest(unittest.TestCase):
+    """Test rasters are mapped in place, or refused when they cannot be."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.values = np.arange(7 * 5, dtype=np.int16).reshape(7, 5) - 10
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def test_npy(self):
+        """Test .npy windows are views of the file."""
+        np.save(self.path('a.npy'), self.values)
+        reader = open_mapped(self.path('a.npy'))
+        window, nodata = reader.read(1, (2, 1, 3, 2))
+        self.assertTrue(isinstance(window.base, np.memmap) or isinstance(window, np.memmap))
+        self.assertTrue((window == self.values[2:5, 1:3]).all())
+        self.assertEqual(nodata, None)
+
+    def test_envi_interleaves(self):
+        """Test every ENVI interleave maps onto the same bands."""
+        bands = np.stack([self.values, self.values * 2, self.values * 3]).astype(np.float32)
+        layouts = {'bsq': bands, 'bil': bands.transpose(1, 0, 2), 'bip': bands.transpose(1, 2, 0)}
+        for interleave, data in layouts.items():
+            raw = self.path(interleave + '.img')
+            np.ascontiguousarray(data).astype('>f4').tofile(raw)
+            with open(self.path(interleave + '.hdr'), 'w') as f:
+                f.write("ENVI\nsamples = 5\nlines = 7\nbands = 3\nheader offset = 0\n"
+                        "data type = 4\ninterleave = {}\nbyte order = 1\n"
+                        "data ignore value = -10\n".format(interleave))
+            reader = open_mapped(raw)
+            self.assertEqual((reader.rows, reader.cols, reader.band_count), (7, 5, 3))
+            for band in (1, 2, 3):
+                window, nodata = reader.read(band, (1, 2, 4, 3))
+                self.assertTrue((window == bands[band - 1, 1:5, 2:5]).all(), interleave)
+                self.assertEqual(nodata, -10.0)
+
+    def test_tiff_strips(self):
+        """Test contiguous uncompressed strips are mapped, in either byte order."""
+        for order in '<>':
+            path = self.path('strips{}.tif'.format(ord(order)))
+            write_tiff(path, self.values, order, nodata=-10)
+            reader = open_mapped(path)
+            self.assertEqual((reader.rows, reader.cols), (7, 5))
+            window, nodata = reader.read(1, (0, 0, 7, 5))
+            self.assertTrue((window == self.values).all())
+            self.assertEqual(nodata, -10.0)
+            scan = RangeScan(reader, tile_budget=16)
+            list(scan.run())
+            (_min, _max, histogram), = scan.result()
+            self.assertEqual((_min, _max), (-9.0, 24.0))
+            self.assertEqual(histogram.total(), self.values.size - 1)
+            self.assertTrue(all(width == 5 for _, _, _, width in scan.windows))
+
+    def test_read_decimated(self):
+        """Test decimated reads sample the same pixels as a strided slice."""
+        np.save(self.path('a.npy'), self.values)
+        values, _ = open_mapped(self.path('a.npy')).read_decimated(1, 3, 2)
+        self.assertTrue((values == self.values[::3, ::3]).all())
+
+    def test_unmappable_files(self):
+        """Test compressed TIFFs and unknown files fall back."""
+        write_tiff(self.path('packed.tif'), self.values, compression=5)
+        self.assertEqual(open_mapped(self.path('packed.tif')), None)
+        with open(self.path('other.img'), 'w') as f:
+            f.write('not a raster')
+        self.assertEqual(open_mapped(self.path('other.img')), None)
+        self.assertEqual(open_mapped(self.path('missing.npy')), None)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,51 @@
+# coding=utf-8
+"""Stage tracing test.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+     it under the terms of the GNU General Public License as published by
+     the Free Software Foundation; either version 2 of the License, or
+     (at your option) any later version.
+
+"""
+
+__author__ = 'ryan.constantino93@gmail.com'
+__date__ = '2017-07-05'
+__copyright__ = 'Copyright 2017, Ryan Constantino'
+
+import unittest
+
+import profiling
+
+
+class ProfilingTest(unittest.TestCase):
+    """Test stage timings are summarized and exported as a trace."""
+
+    def tearDown(self):
+        profiling.set_enabled(False)
+
+    def test_disabled_records_nothing(self):
+        """Test the default tracer hands out the shared no-op span."""
+        tracer = profiling.tracer()
+        self.assertFalse(tracer.enabled)
+        self.assertTrue(tracer.span('render') is profiling.NULL_SPAN)
+        with tracer.span('render'):
+            pass
+
+    def test_summary_and_trace(self):
+        """Test stages are counted and written as complete trace events."""
+        tracer = profiling.set_enabled(True)
+        for _ in range(3):
+            with tracer.span('render'):
+                pass
+        tracer.record('repaint', tracer.origin, tracer.origin + 0.5)
+        summary = dict((stage[0], stage) for stage in tracer.summary())
+        self.assertEqual(summary['render'][1], 3)
+        self.assertEqual(tracer.summary()[0][0], 'repaint')
+        self.assertAlmostEqual(summary['repaint'][2], 500.0)
+        events = tracer.chrome_trace()['traceEvents']
+        self.assertEqual(len(events), 4)
+        self.assertTrue(all(event['ph'] == 'X' for event in events))
+        self.assertTrue(profiling.set_enabled(True) is tracer)
+
+if __name__ == "__main__":
+    unittest.main()
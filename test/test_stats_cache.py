@@ -0,0 +1,131 @@
+# coding=utf-8
+"""Statistics cache test.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+     it under the terms of the GNU General Public License as published by
+     the Free Software Foundation; either version 2 of the License, or
+     (at your option) any later version.
+
+"""
+
+__author__ = 'ryan.constantino93@gmail.com'
+__date__ = '2017-07-05'
+__copyright__ = 'Copyright 2017, Ryan Constantino'
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from histogram import Histogram
+from stats_cache import DiskStatsCache, LayerStats, StatsCache
+from threshold_core import ArrayReader, RangeScan
+
+
+class StatsCacheTest(unittest.TestCase):
+    """Test the per-layer statistics cache."""
+
+    def test_get_put(self):
+        """Test entries are keyed by layer, source and band."""
+        cache = StatsCache()
+        stats = LayerStats(0.0, 10.0, exact=True)
+        cache.put('layer', '/tmp/a.tif', 1, stats)
+        self.assertIs(cache.get('layer', '/tmp/a.tif', 1), stats)
+        self.assertIsNone(cache.get('layer', '/tmp/b.tif', 1))
+        self.assertIsNone(cache.get('layer', '/tmp/a.tif', 2))
+
+    def test_lru_eviction(self):
+        """Test the least recently used entry goes first."""
+        size = LayerStats(0.0, 1.0).nbytes()
+        cache = StatsCache(max_bytes=2 * size)
+        cache.put('a', 'a.tif', 1, LayerStats(0.0, 1.0))
+        cache.put('b', 'b.tif', 1, LayerStats(0.0, 1.0))
+        cache.get('a', 'a.tif', 1)
+        cache.put('c', 'c.tif', 1, LayerStats(0.0, 1.0))
+        self.assertEqual(len(cache), 2)
+        self.assertIsNotNone(cache.get('a', 'a.tif', 1))
+        self.assertIsNone(cache.get('b', 'b.tif', 1))
+
+    def test_invalidate(self):
+        """Test invalidating a layer drops all of its bands."""
+        cache = StatsCache()
+        cache.put('a', 'a.tif', 1, LayerStats(0.0, 1.0))
+        cache.put('a', 'a.tif', 2, LayerStats(0.0, 1.0))
+        cache.put('b', 'b.tif', 1, LayerStats(0.0, 1.0))
+        cache.invalidate('a')
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.size, LayerStats(0.0, 1.0).nbytes())
+
+
+class DiskStatsCacheTest(unittest.TestCase):
+    """Test the persistent statistics cache."""
+
+    def setUp(self):
+        """Runs before each test."""
+        self.directory = tempfile.mkdtemp()
+        self.raster = os.path.join(self.directory, 'raster.tif')
+        with open(self.raster, 'w') as f:
+            f.write('pixels')
+        self.cache = DiskStatsCache(os.path.join(self.directory, 'cache'))
+
+    def tearDown(self):
+        """Runs after each test."""
+        shutil.rmtree(self.directory)
+
+    def test_round_trip(self):
+        """Test stored statistics are read back per band."""
+        self.cache.put(self.raster, 1, LayerStats(-1.5, 3.0, exact=True))
+        stats = self.cache.get(self.raster, 1)
+        self.assertEqual((stats.minimum, stats.maximum, stats.exact), (-1.5, 3.0, True))
+        self.assertIsNone(self.cache.get(self.raster, 2))
+
+    def test_histogram_round_trip(self):
+        """Test the histogram is persisted with the range."""
+        histogram = Histogram(0.0, 1.0, bins=4)
+        histogram.add(np.array([0.1, 0.2, 0.9]))
+        self.cache.put(self.raster, 1, LayerStats(0.1, 0.9, histogram=histogram))
+        stats = self.cache.get(self.raster, 1)
+        self.assertEqual(stats.histogram.counts.tolist(), [2, 0, 0, 1])
+
+    def test_tiles_not_persisted(self):
+        """Test per tile statistics stay in memory, out of the file."""
+        scan = RangeScan(ArrayReader(np.arange(64.0).reshape(8, 8)), tile_budget=128, keep_tiles=True)
+        list(scan.run())
+        (_min, _max, histogram), = scan.result()
+        tiles, = scan.tiles
+        self.cache.put(self.raster, 1, LayerStats(_min, _max, True, histogram=histogram, tiles=tiles))
+        stats = self.cache.get(self.raster, 1)
+        self.assertIsNone(stats.tiles)
+        self.assertEqual(stats.histogram.sparse()[1].tolist(), histogram.sparse()[1].tolist())
+
+    def test_stale_entry(self):
+        """Test an entry is dropped once the file changes."""
+        self.cache.put(self.raster, 1, LayerStats(0.0, 1.0))
+        with open(self.raster, 'a') as f:
+            f.write('more pixels')
+        self.assertIsNone(self.cache.get(self.raster, 1))
+        self.assertFalse(os.path.exists(self.cache.entry_path(self.raster)))
+
+    def test_other_format(self):
+        """Test an entry written in another format is dropped."""
+        self.cache.put(self.raster, 1, LayerStats(0.0, 1.0))
+        entry_path = self.cache.entry_path(self.raster)
+        with open(entry_path) as f:
+            document = json.load(f)
+        document['version'] -= 1
+        with open(entry_path, 'w') as f:
+            json.dump(document, f)
+        self.assertIsNone(self.cache.get(self.raster, 1))
+        self.assertFalse(os.path.exists(entry_path))
+
+    def test_not_a_file(self):
+        """Test non file sources are never cached."""
+        source = 'url=http://example.com/wms'
+        self.cache.put(source, 1, LayerStats(0.0, 1.0))
+        self.assertIsNone(self.cache.get(source, 1))
+
+if __name__ == "__main__":
+    unittest.main()
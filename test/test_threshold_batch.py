@@ -0,0 +1,80 @@
+# coding=utf-8
+"""Batch thresholding test.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+     it under the terms of the GNU General Public License as published by
+     the Free Software Foundation; either version 2 of the License, or
+     (at your option) any later version.
+
+"""
+
+__author__ = 'ryan.constantino93@gmail.com'
+__date__ = '2017-07-05'
+__copyright__ = 'Copyright 2017, Ryan Constantino'
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from threshold_batch import load_state, output_paths, parse_args, parse_color, summarize
+
+
+class ThresholdBatchTest(unittest.TestCase):
+    """Test the batch command's argument handling and resume state."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_parse_color(self):
+        """Test colours default to opaque and keep an explicit alpha."""
+        self.assertEqual(parse_color('#ff8000'), (255, 128, 0, 255))
+        self.assertEqual(parse_color('00000080'), (0, 0, 0, 128))
+
+    def test_one_bit_needs_single_threshold(self):
+        """Test a 1 bit mask is refused with several breakpoints."""
+        self.assertRaises(SystemExit, parse_args,
+                          ['-o', self.directory, '--nbits', '1', '-t', '1', '-t', '2', 'a.tif'])
+
+    def test_auto_percentile_checked(self):
+        """Test --auto only accepts a percentile between 0 and 100."""
+        self.assertEqual(parse_args(['-o', self.directory, '--auto', 'p98', 'a.tif']).auto, 'p98')
+        for value in ('pxx', 'p', 'p101', 'peak'):
+            self.assertRaises(SystemExit, parse_args, ['-o', self.directory, '--auto', value, 'a.tif'])
+
+    def test_output_paths(self):
+        """Test outputs mirror input directories and refuse collisions."""
+        root = os.path.join(os.sep, 'data')
+        a, b = os.path.join(root, 'a', 'x.tif'), os.path.join(root, 'b', 'x.tif')
+        outputs = output_paths([a, b], self.directory)
+        self.assertEqual(outputs[a], os.path.join(self.directory, 'a', 'x_threshold.tif'))
+        self.assertEqual(outputs[b], os.path.join(self.directory, 'b', 'x_threshold.tif'))
+        self.assertEqual(output_paths([a], self.directory)[a],
+                         os.path.join(self.directory, 'x_threshold.tif'))
+        self.assertRaises(ValueError, output_paths, [a, os.path.join(root, 'a', 'x.img')],
+                          self.directory)
+
+    def test_load_state_skips_missing_outputs(self):
+        """Test only rasters with a finished output count as done."""
+        output = os.path.join(self.directory, 'a_threshold.tif')
+        open(output, 'w').close()
+        state_path = os.path.join(self.directory, 'state.jsonl')
+        with open(state_path, 'w') as f:
+            f.write(json.dumps({'input': 'a.tif', 'output': output, 'ok': True}) + '\n')
+            f.write(json.dumps({'input': 'b.tif', 'output': output + '.x', 'ok': True}) + '\n')
+            f.write(json.dumps({'input': 'c.tif', 'output': output, 'ok': False}) + '\n')
+            f.write('{"input": "d.tif", "out')
+        self.assertEqual(list(load_state(state_path)), ['a.tif'])
+
+    def test_summary(self):
+        """Test the summary counts rasters and pixel throughput."""
+        records = [{'ok': True, 'pixels': 4000000}, {'ok': False}]
+        self.assertEqual(summarize(records, 3, 2.0),
+                         "1 done, 1 failed, 3 skipped in 2.0 s: 0.50 rasters/s, 2.0 Mpx/s")
+
+if __name__ == "__main__":
+    unittest.main()
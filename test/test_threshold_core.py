@@ -0,0 +1,150 @@
+# coding=utf-8
+"""Core compute test.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+     it under the terms of the GNU General Public License as published by
+     the Free Software Foundation; either version 2 of the License, or
+     (at your option) any later version.
+
+"""
+
+__author__ = 'ryan.constantino93@gmail.com'
+__date__ = '2017-07-05'
+__copyright__ = 'Copyright 2017, Ryan Constantino'
+
+import unittest
+
+import numpy as np
+
+from threshold_core import (
+    ArrayReader, RangeScan, class_lut, classify, classify_tiles, mask_windows, quantize, valid_mask)
+
+
+class ThresholdCoreTest(unittest.TestCase):
+    """Test the QGIS free range scan, quantization and classification."""
+
+    def setUp(self):
+        values = np.arange(300 * 200, dtype=np.float32).reshape(300, 200) / 100.0
+        values[0, :10] = np.nan
+        values[5, 5] = -9999
+        self.values = values
+
+    def test_scan_ignores_nan_and_nodata(self):
+        """Test the scan range and counts skip NaN and nodata pixels."""
+        reader = ArrayReader(self.values, nodata=-9999)
+        scan = RangeScan(reader, tile_budget=4096)
+        fractions = list(scan.run())
+        self.assertTrue(len(fractions) > 1)
+        self.assertEqual(fractions[-1], 1.0)
+        (_min, _max, histogram), = scan.result()
+        self.assertEqual((_min, _max), (float(self.values[0, 10]), float(self.values[-1, -1])))
+        self.assertEqual(histogram.total(), self.values.size - 11)
+        self.assertFalse(histogram.sampled)
+
+    def test_threaded_scan_matches(self):
+        """Test a threaded scan gives the same result as a serial one."""
+        bands = [self.values, self.values * 2]
+        serial = RangeScan(ArrayReader(bands, nodata=-9999), tile_budget=4096)
+        threaded = RangeScan(ArrayReader(bands, nodata=-9999), tile_budget=4096, threads=4)
+        list(serial.run())
+        list(threaded.run())
+        for a, b in zip(serial.result(), threaded.result()):
+            self.assertEqual(a[:2], b[:2])
+            self.assertTrue((a[2].counts == b[2].counts).all())
+
+    def test_killed_scan_is_sampled(self):
+        """Test a scan stopped early merges the estimate and is sampled."""
+        scan = RangeScan(ArrayReader(self.values, nodata=-9999), [(0.0, 1000.0)], tile_budget=4096)
+        list(scan.run(lambda: scan.done >= 1))
+        (_min, _max, histogram), = scan.result()
+        self.assertEqual(_max, 1000.0)
+        self.assertTrue(histogram.sampled)
+
+    def test_rescan_dirty_region(self):
+        """Test rescanning a rewritten region matches a fresh full scan."""
+        values = self.values.copy()
+        reader = ArrayReader(values, nodata=-9999)
+        scan = RangeScan(reader, [(0.0, 600.0)], tile_budget=4096, keep_tiles=True)
+        list(scan.run())
+        tiles, = scan.tiles
+        # Lower the maximum and add a new minimum in place
+        values[250:, 150:] = 1.0
+        values[10:12, 20:22] = -5.0
+        dirty = tiles.invalidate_region((250, 150, 50, 50))
+        self.assertTrue(0 < tiles.invalidate_region((10, 20, 2, 2)) < len(tiles.windows))
+        self.assertTrue(dirty < len(tiles.windows))
+        list(tiles.rescan(reader, 1, threads=2))
+        self.assertEqual(tiles.dirty, set())
+        fresh = RangeScan(ArrayReader(values.copy(), nodata=-9999), [(0.0, 600.0)], tile_budget=4096)
+        list(fresh.run())
+        (_min, _max, histogram), = fresh.result()
+        self.assertEqual(tiles.range(), (_min, _max))
+        self.assertEqual(tiles.histogram.level, histogram.level)
+        for a, b in zip(tiles.histogram.sparse(), histogram.sparse()):
+            self.assertEqual(a.tolist(), b.tolist())
+
+    def test_rescan_past_bounds(self):
+        """Test a region rewritten past the scanned range is binned anew."""
+        values = self.values.copy()
+        reader = ArrayReader(values, nodata=-9999)
+        scan = RangeScan(reader, tile_budget=4096, keep_tiles=True)
+        list(scan.run())
+        tiles, = scan.tiles
+        values[40:60, 40:60] = 1e6
+        tiles.invalidate_region((40, 40, 20, 20))
+        list(tiles.rescan(reader, 1))
+        self.assertEqual(tiles.range()[1], 1e6)
+        self.assertEqual(tiles.histogram.count_above(5e5), 400)
+        self.assertTrue(tiles.histogram.hi >= 1e6)
+
+    def test_scan_bins_values_past_estimate(self):
+        """Test a scan whose estimate missed a hot spot still counts above it."""
+        values = self.values.copy()
+        values[100:110, 100:110] = 5000.0
+        scan = RangeScan(ArrayReader(values, nodata=-9999), [(0.0, 600.0)], tile_budget=4096, threads=2)
+        list(scan.run())
+        (_min, _max, histogram), = scan.result()
+        self.assertEqual(_max, 5000.0)
+        self.assertEqual(histogram.count_above(1000.0), 100)
+        self.assertEqual(histogram.count_above(4000.0), 100)
+        self.assertTrue(histogram.hi >= 5000.0)
+
+    def test_quantize_agrees_with_threshold(self):
+        """Test the colour of every quantized pixel matches its class."""
+        values = np.round(np.nan_to_num(self.values), 2)
+        valid = valid_mask(values, -9999)
+        index, levels = quantize(values, valid, 0.0, 600.0, 2)
+        lut = class_lut(levels, [150.25], [1, 2])
+        expected = np.where(values <= 150.25, 1, 2)
+        self.assertTrue((lut.take(index)[valid] == expected[valid]).all())
+        self.assertEqual(lut.take(index)[5, 5], 0)
+
+    def test_quantize_sweep(self):
+        """Test levels agree with values for every slider threshold."""
+        for precision in (1, 2, 3):
+            scale = 10.0 ** precision
+            values = np.arange(-1500, 1501) / scale
+            valid = np.ones(values.shape, dtype=bool)
+            index, levels = quantize(values, valid, values[0], values[-1], precision)
+            for position in range(-1500, 1501, 7):
+                threshold = position / scale
+                lut = class_lut(levels, [threshold], [1, 2])
+                expected = np.where(values <= threshold, 1, 2)
+                self.assertEqual((lut.take(index) != expected).sum(), 0, (precision, threshold))
+
+    def test_classify_tiles(self):
+        """Test tiled classification covers the band, nodata included."""
+        reader = ArrayReader(self.values, nodata=-9999)
+        windows = mask_windows(reader.rows, reader.cols, 8 * 64 * 64, threads=2, align=64)
+        self.assertTrue(all(w[0] % 64 == 0 and w[1] % 64 == 0 for w in windows))
+        out = np.zeros(self.values.shape, dtype=np.uint8)
+        for (row, col, height, width), classes in zip(windows, classify_tiles(
+                reader, 1, windows, [100.0, 400.0], threads=2)):
+            out[row:row + height, col:col + width] = classes
+        expected = classify(self.values, valid_mask(self.values, -9999), [100.0, 400.0])
+        self.assertTrue((out == expected).all())
+        self.assertEqual(out[0, 0], 255)
+        self.assertEqual(out[-1, -1], 2)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,295 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ Threshold
+                                 A QGIS plugin
+ Adds context controls for brightness and contrast
+                              -------------------
+        begin                : 2017-07-05
+        git sha              : $Format:%H$
+        copyright            : (C) 2017 by Ryan Constantino
+        email                : ryan.constantino93@gmail.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+
+Headless batch thresholding.
+
+Scans and classifies many rasters with the same threshold and colour
+settings as the plugin, one raster per process. Only GDAL and NumPy are
+needed, QGIS is not started. For example:
+
+    python threshold_batch.py --threshold 0.4 --out masks "tiles/*.tif"
+    python threshold_batch.py --auto otsu --nbits 1 --out masks -f list.txt
+
+Every finished raster is appended to a state file in the output directory,
+so an interrupted run picks up where it stopped when started again.
+"""
+import argparse
+import glob
+import json
+import multiprocessing
+import os
+import sys
+import time
+import traceback
+from mask_export import GdalReader, export_mask
+from mmap_reader import open_mapped
+from stats_cache import DiskStatsCache, LayerStats
+from threshold_core import RangeScan, auto_threshold
+
+# Output file name suffix of a classified raster
+OUTPUT_SUFFIX = '_threshold.tif'
+# Name of the state file, in the output directory, listing finished rasters
+STATE_FILE = 'threshold_batch.jsonl'
+
+
+def parse_color(text):
+    """Parse '#rrggbb' or '#rrggbbaa' into an (r, g, b, a) tuple."""
+    value = text.strip().lstrip('#')
+    if len(value) not in (6, 8):
+        raise argparse.ArgumentTypeError("Invalid colour '{}'".format(text))
+    try:
+        channels = [int(value[i:i + 2], 16) for i in range(0, len(value), 2)]
+    except ValueError:
+        raise argparse.ArgumentTypeError("Invalid colour '{}'".format(text))
+    return tuple(channels + [255] * (4 - len(channels)))
+
+
+def collect_inputs(patterns, list_files):
+    """Expand globs and file lists into a sorted list of unique paths."""
+    paths = set()
+    for pattern in patterns:
+        matches = glob.glob(pattern)
+        paths.update(matches if matches else [pattern])
+    for list_file in list_files:
+        with open(list_file) as f:
+            paths.update(line.strip() for line in f if line.strip() and not line.startswith('#'))
+    return sorted(os.path.abspath(path) for path in paths)
+
+
+def output_paths(paths, output_dir):
+    """Return {input path: output path} for absolute input paths.
+
+    Outputs mirror the directories of the inputs below their common
+    parent, so rasters sharing a name in different directories do not
+    overwrite each other; inputs all in one directory map straight into
+    output_dir.
+
+    :raises ValueError: When two inputs would still share an output, as
+        rasters differing only by extension do.
+    """
+    if not paths:
+        return {}
+    parent = os.path.commonprefix([os.path.dirname(path) + os.sep for path in paths])
+    parent = parent[:parent.rfind(os.sep) + 1]
+    outputs = {}
+    for path in paths:
+        name = os.path.splitext(path[len(parent):])[0]
+        outputs[path] = os.path.join(output_dir, name + OUTPUT_SUFFIX)
+    taken = {}
+    for path, output in sorted(outputs.items()):
+        if output in taken:
+            raise ValueError("'{}' and '{}' would both be written to '{}'".format(
+                taken[output], path, output))
+        taken[output] = path
+    return outputs
+
+
+def load_state(state_path):
+    """Return {input path: record} of the rasters a previous run finished."""
+    done = {}
+    if not os.path.isfile(state_path):
+        return done
+    with open(state_path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # A line cut short by an interrupted run
+                continue
+            if record.get('ok') and os.path.isfile(record.get('output', '')):
+                done[record['input']] = record
+    return done
+
+
+def resolve_breaks(options, histogram):
+    """Class breakpoints for one raster, fixed or from its histogram."""
+    if options['thresholds']:
+        return sorted(options['thresholds'])
+    method = options['auto']
+    if method.startswith('p'):
+        return [auto_threshold(histogram, 'percentile', float(method[1:]))]
+    return [auto_threshold(histogram, method)]
+
+
+def process_raster(task):
+    """Scan and classify one raster; never raises, failures are recorded.
+
+    :param task: (input path, output path, options dict)
+    :type task: tuple
+
+    :returns: Record of the run for the state file.
+    :rtype: dict
+    """
+    path, output, options = task
+    started = time.time()
+    record = {'input': path, 'output': output, 'ok': False}
+    try:
+        source = GdalReader(path)
+        # Pixels are read from a memory map when the format allows it,
+        # with the nodata values GDAL reports
+        nodata = [source.dataset().GetRasterBand(number).GetNoDataValue()
+                  for number in range(1, source.band_count + 1)]
+        reader = open_mapped(path, nodata) or source
+        band = options['band']
+        if not 1 <= band <= reader.band_count:
+            raise ValueError("Raster has no band {}".format(band))
+        scan = RangeScan(reader, tile_budget=options['tile_budget'], threads=options['threads'])
+        for _ in scan.run():
+            pass
+        ranges = scan.result()
+        if options['stats_cache']:
+            cache = DiskStatsCache(options['stats_cache'])
+            for number, (_min, _max, histogram) in enumerate(ranges, 1):
+                if _min <= _max:
+                    cache.put(path, number, LayerStats(_min, _max, True, histogram=histogram))
+        _min, _max, histogram = ranges[band - 1]
+        breaks = resolve_breaks(options, histogram)
+        colors = options['colors']
+        if colors is not None and len(colors) != len(breaks) + 1:
+            raise ValueError("{} breakpoints need {} colours, got {}".format(
+                len(breaks), len(breaks) + 1, len(colors)))
+
+        # Only complete outputs ever carry the final name
+        export_mask(reader, band, output, source.geotransform(), source.wkt(), breaks,
+                    options['nbits'], options['threads'], options['tile_budget'], colors=colors)
+        record.update(ok=True, min=_min, max=_max, breaks=breaks,
+                      pixels=reader.rows * reader.cols)
+    except Exception, e:
+        record['error'] = '{}: {}'.format(type(e).__name__, e)
+        record['traceback'] = traceback.format_exc()
+    record['seconds'] = time.time() - started
+    return record
+
+
+def summarize(records, skipped, elapsed):
+    """One line summary of a run, with the throughput of the rasters done."""
+    done = [record for record in records if record['ok']]
+    pixels = sum(record['pixels'] for record in done)
+    rate = pixels / elapsed / 1e6 if elapsed > 0 else 0.0
+    return ("{} done, {} failed, {} skipped in {:.1f} s: {:.2f} rasters/s, "
+            "{:.1f} Mpx/s").format(len(done), len(records) - len(done), skipped, elapsed,
+                                   len(done) / elapsed if elapsed > 0 else 0.0, rate)
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Threshold many rasters without the QGIS GUI.")
+    parser.add_argument('inputs', nargs='*', help="Raster files or glob patterns")
+    parser.add_argument('-f', '--file-list', action='append', default=[],
+                        help="Text file listing one raster per line")
+    parser.add_argument('-o', '--out', required=True, help="Output directory")
+    spec = parser.add_mutually_exclusive_group(required=True)
+    spec.add_argument('-t', '--threshold', type=float, action='append',
+                      help="Class breakpoint; repeat for more classes")
+    spec.add_argument('--auto', help="otsu, triangle or pNN (percentile) per raster")
+    parser.add_argument('-b', '--band', type=int, default=1)
+    parser.add_argument('--nbits', type=int, choices=(1, 8), default=8)
+    parser.add_argument('--colors', help="Comma separated #rrggbb[aa] colour of every class, "
+                                         "lowest first, ending with the base colour")
+    parser.add_argument('-j', '--processes', type=int, default=multiprocessing.cpu_count())
+    parser.add_argument('--threads', type=int, default=1, help="Threads per process")
+    parser.add_argument('--tile-budget-mb', type=int, default=64)
+    parser.add_argument('--stats-cache', help="Directory of the plugin's statistics cache to fill")
+    parser.add_argument('--restart', action='store_true', help="Ignore the state of earlier runs")
+    args = parser.parse_args(argv)
+    if args.auto and args.auto not in ('otsu', 'triangle'):
+        try:
+            percentile = float(args.auto[1:]) if args.auto.startswith('p') else None
+        except ValueError:
+            percentile = None
+        if percentile is None or not 0 <= percentile <= 100:
+            parser.error("--auto must be otsu, triangle or pNN with NN between 0 and 100")
+    if args.nbits == 1 and (args.auto is None and len(args.threshold) != 1):
+        parser.error("A 1 bit mask needs a single threshold")
+    return args
+
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    paths = collect_inputs(args.inputs, args.file_list)
+    if not paths:
+        print "No input rasters"
+        return 1
+    if not os.path.isdir(args.out):
+        os.makedirs(args.out)
+    options = {
+        'thresholds': args.threshold,
+        'auto': args.auto,
+        'band': args.band,
+        'nbits': args.nbits,
+        'colors': [parse_color(color) for color in args.colors.split(',')] if args.colors else None,
+        'threads': max(args.threads, 1),
+        'tile_budget': args.tile_budget_mb * 1024 * 1024,
+        'stats_cache': args.stats_cache,
+    }
+
+    state_path = os.path.join(args.out, STATE_FILE)
+    if args.restart and os.path.isfile(state_path):
+        os.remove(state_path)
+    try:
+        outputs = output_paths(paths, args.out)
+    except ValueError, e:
+        print e
+        return 1
+    done = load_state(state_path)
+    tasks = [(path, outputs[path], options) for path in paths if path not in done]
+    for directory in set(os.path.dirname(output) for _, output, _ in tasks):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+    # The state file may list rasters that are not part of this run
+    skipped = len(paths) - len(tasks)
+    print "{} rasters, {} already done, {} to process".format(len(paths), skipped, len(tasks))
+
+    started = time.time()
+    records = []
+    processes = min(max(args.processes, 1), len(tasks)) if tasks else 1
+    pool = multiprocessing.Pool(processes) if processes > 1 else None
+    results = pool.imap_unordered(process_raster, tasks) if pool else (process_raster(task) for task in tasks)
+    try:
+        with open(state_path, 'a') as state:
+            for record in results:
+                records.append(record)
+                trace = record.pop('traceback', None)
+                state.write(json.dumps(record) + '\n')
+                state.flush()
+                if record['ok']:
+                    print "[{}/{}] {} ({:.1f} s)".format(len(records), len(tasks), record['input'],
+                                                        record['seconds'])
+                else:
+                    print "[{}/{}] {} FAILED: {}".format(len(records), len(tasks), record['input'],
+                                                        record['error'])
+                    if trace:
+                        sys.stderr.write(trace)
+    except KeyboardInterrupt:
+        print "Interrupted, run again to resume"
+        if pool is not None:
+            pool.terminate()
+        return 130
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    print summarize(records, skipped, time.time() - started)
+    return 0 if all(record['ok'] for record in records) else 2
+
+
+if __name__ == '__main__':
+    sys.exit(main())
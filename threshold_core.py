@@ -0,0 +1,539 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ Threshold
+                                 A QGIS plugin
+ Adds context controls for brightness and contrast
+                              -------------------
+        begin                : 2017-07-05
+        git sha              : $Format:%H$
+        copyright            : (C) 2017 by Ryan Constantino
+        email                : ryan.constantino93@gmail.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+
+Numeric core of the plugin: range scans, histograms, quantization and
+classification, on NumPy arrays only. Nothing here imports QGIS or Qt.
+
+Pixels are read through readers, objects with:
+
+    rows, cols, band_count
+    dtype(band)                       NumPy dtype of band
+    read(band, window)                (values, nodata) of a (row, col,
+                                      height, width) window
+    read_decimated(band, height, width)
+                                      (values, nodata) of the whole band
+                                      resampled to height x width
+
+Bands are numbered from 1 and nodata is None when the band has none.
+Readers that read whole rows fastest set a full_rows attribute to True,
+and are then given windows spanning whole rows.
+ArrayReader serves arrays already in memory; the plugin and the batch
+command provide readers over QGIS providers and GDAL datasets.
+"""
+from multiprocessing.pool import ThreadPool
+from itertools import imap
+import math
+import numpy as np
+from histogram import Histogram
+import profiling
+
+# Default upper bound, in bytes, on the raw pixel buffer of a single tile
+DEFAULT_TILE_BUDGET = 64 * 1024 * 1024
+# Longest side, in pixels, of the decimated read used for the first estimate
+ESTIMATE_SIZE = 512
+# Most levels an index raster may have; one more code is kept for nodata
+MAX_LEVELS = 65535
+# Relative slack, in steps, within which a value counts as on a step
+STEP_TOLERANCE = 1e-9
+# Class written for nodata pixels in 8 bit masks
+NODATA_CLASS = 255
+
+
+def valid_mask(values, nodata=None):
+    """Mask of the pixels of values that are finite and not nodata."""
+    valid = np.ones(values.shape, dtype=bool)
+    if values.dtype.kind == 'f':
+        valid &= np.isfinite(values)
+    if nodata is not None and not math.isnan(nodata):
+        valid &= values != values.dtype.type(nodata)
+    return valid
+
+
+def valid_values(arr, nodata=None):
+    """Return the values of arr that are finite and not nodata, flattened."""
+    if arr.dtype.kind != 'f' and (nodata is None or math.isnan(nodata)):
+        return arr.ravel()
+    return arr[valid_mask(arr, nodata)]
+
+
+def values_range(values):
+    """(min, max) of a flat array of valid values.
+
+    Returns (inf, -inf) when it is empty, which is what the plugin treats
+    as "range not computed yet".
+    """
+    if values.size == 0:
+        return (float("inf"), float("-inf"))
+    return (float(values.min()), float(values.max()))
+
+
+def array_range(arr, nodata=None):
+    """Vectorized (min, max) of arr ignoring inf, NaN and nodata."""
+    return values_range(valid_values(arr, nodata))
+
+
+def merge_ranges(a, b):
+    """Combine two partial (min, max) results into one."""
+    return (min(a[0], b[0]), max(a[1], b[1]))
+
+
+def tile_shape(rows, cols, itemsize, budget=DEFAULT_TILE_BUDGET, full_rows=False):
+    """Pick a (tile_rows, tile_cols) window whose buffer fits in budget bytes.
+
+    Windows are kept roughly square so tiled formats are read along their
+    internal blocks, but never wider or taller than the raster itself.
+    With full_rows they span whole rows instead.
+    """
+    pixels = max(budget // itemsize, 1)
+    if full_rows:
+        tile_cols = cols
+    else:
+        tile_cols = min(cols, max(int(math.sqrt(pixels)), 1))
+    tile_rows = min(rows, max(pixels // tile_cols, 1))
+    return (tile_rows, tile_cols)
+
+
+def iter_tiles(rows, cols, tile_rows, tile_cols):
+    """Yield (row, col, height, width) windows covering a rows x cols grid."""
+    for row in range(0, rows, tile_rows):
+        for col in range(0, cols, tile_cols):
+            yield (row, col, min(tile_rows, rows - row), min(tile_cols, cols - col))
+
+
+def estimate_range(reader, band, size=ESTIMATE_SIZE):
+    """Estimate the range from one decimated read of the whole band.
+
+    Readers over files resample the request from overviews where they
+    have them, so this costs a few milliseconds whatever the raster size,
+    but it can miss extremes narrower than the sampling step.
+    """
+    scale = min(float(size) / max(reader.rows, reader.cols), 1.0)
+    height = max(int(reader.rows * scale), 1)
+    width = max(int(reader.cols * scale), 1)
+    values, nodata = reader.read_decimated(band, height, width)
+    return array_range(values, nodata)
+
+
+class ArrayReader(object):
+    """Reader over arrays in memory, read as zero-copy views."""
+
+    def __init__(self, bands, nodata=None):
+        """Constructor.
+
+        :param bands: A (rows, cols) array, or a (bands, rows, cols) array
+            or sequence of (rows, cols) arrays.
+        :type bands: numpy.ndarray
+
+        :param nodata: Nodata value shared by all the bands, if any.
+        :type nodata: float
+        """
+        if isinstance(bands, np.ndarray) and bands.ndim == 2:
+            bands = [bands]
+        self.bands = list(bands)
+        self.nodata = nodata
+        self.band_count = len(self.bands)
+        self.rows, self.cols = self.bands[0].shape
+
+    def dtype(self, band):
+        return self.bands[band - 1].dtype
+
+    def read(self, band, window):
+        row, col, height, width = window
+        return self.bands[band - 1][row:row + height, col:col + width], self.nodata
+
+    def read_decimated(self, band, height, width):
+        row_step = int(math.ceil(self.rows / float(height)))
+        col_step = int(math.ceil(self.cols / float(width)))
+        return self.bands[band - 1][::row_step, ::col_step], self.nodata
+
+
+def scan_window(reader, window, histograms, killed=None):
+    """Reduce one window of every band to a partial (min, max) and a
+    partial histogram sharing the bins of the band's entry in histograms.
+
+    Bands without a histogram (None) are skipped and get None back.
+    """
+    partials = [((float("inf"), float("-inf")), histogram.empty_like()) if histogram else None
+                for histogram in histograms]
+    if killed is not None and killed():
+        return partials
+    tracer = profiling.tracer()
+    for band, partial in enumerate(partials, 1):
+        if partial is None:
+            continue
+        with tracer.span('scan.read'):
+            values, nodata = reader.read(band, window)
+        with tracer.span('scan.reduce'):
+            values = valid_values(values, nodata)
+            partial[1].add(values)
+            partials[band - 1] = (values_range(values), partial[1])
+    return partials
+
+
+class RangeScan(object):
+    """Exact range and histogram of every band of a reader.
+
+    All the bands are reduced in a single pass, one window at a time so
+    that peak memory is bounded by the tile budget rather than by the
+    raster. With more than one thread, windows are reduced by a pool and
+    the partial results merged as they complete.
+
+    The histograms are laid over the estimated ranges given to the
+    constructor and grow to take values past them, so they end up binned
+    over the exact range whatever the estimate.
+
+    With keep_tiles, the result of every window is also kept in a
+    TileStats per band, so that the windows can be rescanned later.
+    """
+
+    def __init__(self, reader, estimates=None, tile_budget=DEFAULT_TILE_BUDGET, threads=1,
+                 keep_tiles=False):
+        """Constructor.
+
+        :param reader: Source of pixel windows, see the module docstring.
+
+        :param estimates: Approximate (min, max) of every band; taken from
+            estimate_range when not given.
+        :type estimates: list
+
+        :param tile_budget: Bytes of pixels held per window and thread.
+        :type tile_budget: int
+
+        :param threads: Number of threads reducing windows.
+        :type threads: int
+
+        :param keep_tiles: Keep the result of every window in tiles.
+        :type keep_tiles: bool
+        """
+        self.reader = reader
+        self.threads = max(int(threads), 1)
+        bands = range(1, reader.band_count + 1)
+        if estimates is None:
+            estimates = [estimate_range(reader, band) for band in bands]
+        self.estimates = estimates
+        dtypes = [np.dtype(reader.dtype(band)) for band in bands]
+        self.histograms = [
+            Histogram.for_values(dtype, *(estimate if estimate[0] <= estimate[1] else (0.0, 1.0)))
+            for dtype, estimate in zip(dtypes, estimates)]
+        self.ranges = [(float("inf"), float("-inf")) for band in bands]
+        # Every pool thread holds one window of every band in flight, so
+        # the budget is split across threads and bands
+        itemsize = sum(dtype.itemsize for dtype in dtypes)
+        tile_rows, tile_cols = tile_shape(reader.rows, reader.cols, itemsize,
+                                          tile_budget // self.threads,
+                                          getattr(reader, 'full_rows', False))
+        self.windows = list(iter_tiles(reader.rows, reader.cols, tile_rows, tile_cols))
+        self.tiles = None
+        if keep_tiles:
+            self.tiles = [TileStats(self.windows, histogram) for histogram in self.histograms]
+        self.done = 0
+        self.killed = None
+
+    def scan_tile(self, index):
+        """Reduce window index of every band, see scan_window."""
+        return index, scan_window(self.reader, self.windows[index], self.histograms, self.killed)
+
+    def run(self, killed=None):
+        """Scan the windows, yielding the fraction done after each merge.
+
+        :param killed: Optional callback returning True to stop early.
+        :type killed: function
+        """
+        self.killed = killed
+        pool = ThreadPool(self.threads) if self.threads > 1 else None
+        indexes = range(len(self.windows))
+        partials = pool.imap_unordered(self.scan_tile, indexes) if pool else imap(self.scan_tile, indexes)
+        try:
+            for index, tile in partials:
+                if killed is not None and killed():
+                    break
+                for band, (partial, histogram) in enumerate(tile):
+                    self.ranges[band] = merge_ranges(self.ranges[band], partial)
+                    self.histograms[band].merge(histogram)
+                    if self.tiles is not None:
+                        self.tiles[band].store(index, partial, histogram)
+                self.done += 1
+                yield self.done / float(len(self.windows))
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+
+    def complete(self):
+        return self.done == len(self.windows)
+
+    def result(self):
+        """(min, max, histogram) of every band.
+
+        A scan stopped early still knows more than the estimates alone: its
+        ranges are merged with them and its histograms flagged as sampled.
+        """
+        ranges = self.ranges
+        if not self.complete():
+            for histogram in self.histograms:
+                histogram.sampled = True
+            ranges = [merge_ranges(a, b) for a, b in zip(self.estimates, ranges)]
+        return tuple(result + (histogram,) for result, histogram in zip(ranges, self.histograms))
+
+
+class TileStats(object):
+    """Range and histogram of every window of one band, from a RangeScan.
+
+    Kept for rasters that are rewritten in place: when a region is
+    reported dirty, only the windows overlapping it are rescanned, and
+    the range and histogram of the band are merged again from the
+    windows. The histogram is updated by taking the old counts of each
+    rescanned window out and adding the new ones in, so a rescan costs
+    the dirty windows only, whatever the size of the raster.
+
+    Histograms are kept per window as their non-empty bins, so a window
+    of a 16 bit band costs no more than its distinct values.
+    """
+
+    def __init__(self, windows, histogram):
+        """Constructor.
+
+        :param windows: (row, col, height, width) windows of the scan.
+        :type windows: list
+
+        :param histogram: Histogram of the band, merged from the windows;
+            kept up to date by rescans.
+        :type histogram: Histogram
+        """
+        self.windows = windows
+        self.histogram = histogram
+        self.ranges = [None] * len(windows)
+        # Per window (histogram level, bin positions, counts)
+        self.counts = [None] * len(windows)
+        self.dirty = set()
+
+    def store(self, index, partial, histogram):
+        """Keep the (min, max) and histogram of window index."""
+        self.ranges[index] = partial
+        self.counts[index] = (histogram.level,) + histogram.sparse()
+
+    def replace(self, index, partial, histogram):
+        """Swap the result of window index for a new one, in the merged
+        histogram too."""
+        level, old_index, old_counts = self.counts[index]
+        self.histogram.add_sparse(old_index, -old_counts, level)
+        self.histogram.merge(histogram)
+        self.store(index, partial, histogram)
+
+    def complete(self):
+        return None not in self.ranges
+
+    def invalidate_region(self, region):
+        """Mark the windows overlapping a (row, col, height, width) region
+        as dirty, and return how many are dirty now."""
+        row, col, height, width = region
+        for index, (top, left, rows, cols) in enumerate(self.windows):
+            if top < row + height and row < top + rows and left < col + width and col < left + cols:
+                self.dirty.add(index)
+        return len(self.dirty)
+
+    def rescan(self, reader, band, threads=1, killed=None):
+        """Rescan the dirty windows of band, yielding the fraction done
+        after each. Windows not reached when killed stay dirty.
+        """
+        indexes = sorted(self.dirty)
+        histograms = [None] * reader.band_count
+        histograms[band - 1] = self.histogram
+
+        def scan(index):
+            return index, scan_window(reader, self.windows[index], histograms, killed)[band - 1]
+
+        pool = ThreadPool(threads) if threads > 1 and len(indexes) > 1 else None
+        try:
+            partials = pool.imap_unordered(scan, indexes) if pool else imap(scan, indexes)
+            for done, (index, (partial, histogram)) in enumerate(partials, 1):
+                if killed is not None and killed():
+                    break
+                self.replace(index, partial, histogram)
+                self.dirty.discard(index)
+                yield done / float(len(indexes))
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+
+    def range(self):
+        """(min, max) of the band, merged from the windows."""
+        return reduce(merge_ranges, [partial for partial in self.ranges if partial is not None],
+                      (float("inf"), float("-inf")))
+
+    def result(self):
+        """(min, max, histogram), as in RangeScan.result."""
+        return self.range() + (self.histogram,)
+
+    def copy(self):
+        """Copy whose rescans leave this one, and its histogram, untouched."""
+        tiles = TileStats(self.windows, self.histogram.copy())
+        tiles.ranges = list(self.ranges)
+        tiles.counts = list(self.counts)
+        tiles.dirty = set(self.dirty)
+        return tiles
+
+    def nbytes(self):
+        return sum(index.nbytes + counts.nbytes for _, index, counts, _, _ in filter(None, self.counts))
+
+
+def auto_threshold(histogram, method, percent=None):
+    """Suggest a threshold from a histogram.
+
+    :param method: 'otsu', 'triangle' or 'percentile'.
+    :type method: str
+
+    :param percent: Percentile, from 0 to 100, for the percentile method.
+    :type percent: float
+    """
+    if method == 'otsu':
+        return histogram.otsu()
+    if method == 'triangle':
+        return histogram.triangle()
+    if method == 'percentile':
+        return histogram.percentile(percent)
+    raise ValueError("Unknown threshold method '{}'".format(method))
+
+
+def step_units(values, start, step):
+    """Steps from start to every value, and the slack within which a
+    value counts as on a whole step despite the float error of the
+    division."""
+    units = (np.asarray(values, dtype=np.float64) - start) / step
+    return units, (np.abs(units) + 1) * STEP_TOLERANCE
+
+
+def quantize(values, valid, lo, hi, precision):
+    """Quantize values into a compact index raster along precision steps.
+
+    Level i stands for the values in (start + (i - 1) * step, start + i * step],
+    where step is 10 ** -precision and start is lo rounded down to a whole
+    step. Levels and thresholds are both compared in whole steps (see
+    class_lut), so "value <= threshold" and "level <= level of threshold"
+    agree for every threshold the slider can produce. The step is
+    coarsened by powers of ten when [lo, hi] would need more than
+    MAX_LEVELS levels. Invalid pixels get the code count, one past the
+    last level.
+
+    :returns: (index raster, (start, step, count) of the levels)
+    :rtype: (numpy.ndarray, tuple)
+    """
+    step = 10.0 ** -precision
+    while (hi - lo) / step + 2 > MAX_LEVELS:
+        step *= 10
+    start = math.floor(lo / step) * step
+    count = int(math.ceil((hi - start) / step)) + 1
+    dtype = np.uint8 if count < 255 else np.uint16
+    units, slack = step_units(values, start, step)
+    index = np.ceil(units - slack)
+    np.clip(index, 0, count - 1, out=index)
+    index = index.astype(dtype)
+    index[~valid] = count
+    return index, (start, step, count)
+
+
+def class_lut(levels, breaks, colors):
+    """Colour lookup table for an index raster from quantize.
+
+    Class i holds the levels in (breaks[i - 1], breaks[i]] and is drawn in
+    colors[i]; levels above the last break get colors[-1]. Building the
+    table costs O(levels * log(classes)) and applying it one lookup per
+    pixel, whatever the number of classes.
+
+    :param levels: (start, step, count) of the levels, as returned by
+        quantize.
+    :type levels: tuple
+
+    :param breaks: Ascending upper bounds of the classes.
+    :type breaks: list
+
+    :param colors: ARGB colours, as returned by QColor.rgba(), one more
+        than there are breaks.
+    :type colors: list
+
+    :returns: ARGB32 colour per code, the last one transparent for nodata.
+    :rtype: numpy.ndarray of uint32
+    """
+    start, step, count = levels
+    # Level i is at or below a break when i is at most its whole steps
+    units, slack = step_units(breaks, start, step)
+    units = np.floor(units + slack)
+    lut = np.zeros(count + 1, dtype=np.uint32)
+    classes = np.searchsorted(units, np.arange(count), side='left')
+    lut[:-1] = np.asarray(colors, dtype=np.uint32)[classes]
+    return lut
+
+
+def classify(values, valid, breaks):
+    """Classify a tile of values against ascending breakpoints.
+
+    Class i holds the values in (breaks[i - 1], breaks[i]]; with a single
+    breakpoint this is a binary mask, 1 above the threshold and 0 at or
+    below it. Invalid pixels get NODATA_CLASS.
+
+    :rtype: numpy.ndarray of uint8
+    """
+    classes = np.searchsorted(np.asarray(breaks, dtype=np.float64), values, side='left')
+    classes = classes.astype(np.uint8)
+    classes[~valid] = NODATA_CLASS
+    return classes
+
+
+def mask_windows(rows, cols, tile_budget=DEFAULT_TILE_BUDGET, threads=1, align=1, full_rows=False):
+    """Windows to classify a rows x cols band in, as multiples of align.
+
+    Classification holds a float64 comparison buffer per pixel, so the
+    budget is counted at 8 bytes a pixel and split across threads.
+    """
+    tile_rows, tile_cols = tile_shape(rows, cols, 8, tile_budget // max(threads, 1), full_rows)
+    tile_rows = max(tile_rows // align, 1) * align
+    if not full_rows:
+        tile_cols = max(tile_cols // align, 1) * align
+    return list(iter_tiles(rows, cols, tile_rows, tile_cols))
+
+
+def classify_tiles(reader, band, windows, breaks, threads=1):
+    """Yield the classes of every window, in the order of windows.
+
+    Windows are classified on a pool of threads, a few at a time so that
+    finished tiles never pile up in memory while the caller consumes them.
+    """
+    tracer = profiling.tracer()
+
+    def classify_window(window):
+        with tracer.span('export.read'):
+            values, nodata = reader.read(band, window)
+        with tracer.span('export.classify'):
+            return classify(values, valid_mask(values, nodata), breaks)
+
+    pool = ThreadPool(threads) if threads > 1 else None
+    try:
+        chunk = max(threads, 1) * 2
+        for start in range(0, len(windows), chunk):
+            batch = windows[start:start + chunk]
+            for classes in (pool.imap(classify_window, batch) if pool else imap(classify_window, batch)):
+                yield classes
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
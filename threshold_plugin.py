@@ -24,47 +24,19 @@ from qgis.core import *
 from qgis.gui import *
 from PyQt4.QtCore import QSettings, QTranslator, qVersion, QCoreApplication, QTimer, Qt, QThread
 from PyQt4.QtGui import *
-# Initialize Qt resources from file resources.py
-import resources
-# Import the code for the dialog
-from threshold_plugin_dialog import ThresholdDialog
 import os.path
 import math
-from Worker import Worker
+from render_scheduler import RenderScheduler
+import profiling
 import time
+# The dialog and the numeric modules (NumPy, GDAL) are imported by
+# Threshold.load(), when the plugin is first opened. The compiled Qt
+# resources are not imported at all: the icon is read from disk.
 
-# For @throttle
-from datetime import datetime, timedelta
-from functools import wraps
-
-class throttle(object):
-    """
-    Decorator that prevents a function from being called more than once every
-    time period.
-
-    To create a function that cannot be called more than once a minute:
-
-        @throttle(minutes=1)
-        def my_fun():
-            pass
-    """
-    def __init__(self, seconds=0, minutes=0, hours=0):
-        self.throttle_period = timedelta(
-            seconds=seconds, minutes=minutes, hours=hours
-        )
-        self.time_of_last_call = datetime.min
-
-    def __call__(self, fn):
-        @wraps(fn)
-        def wrapper(*args, **kwargs):
-            now = datetime.now()
-            time_since_last_call = now - self.time_of_last_call
-
-            if time_since_last_call > self.throttle_period:
-                self.time_of_last_call = now
-                return fn(*args, **kwargs)
-
-        return wrapper
+# Delay, in ms, after which a value held while dragging gets a full render
+SETTLE_DELAY = 300
+# Repaint time, in ms, under which dragging renders the layer directly
+FAST_REPAINT = 50
 
 class Threshold:
     """QGIS Plugin Implementation."""
@@ -83,17 +55,50 @@ class Threshold:
         self.fcn = None
         self.shader = None
         self.renderer = None
+        # Per layer id: [renderer, ramp shader, key of the ramp it shows]
+        self.renderers = {}
         self.WHITE = QColor(255, 255, 255)
         self.BLACK = QColor(0, 0, 0)
-        self.color_picker = QColorDialog()
-        self.color_picker.setOption(QColorDialog.ShowAlphaChannel, on=True)
+        # Built on first use, see load() and get_color_picker()
+        self.dlg = None
+        self.color_picker = None
+        self.brightnessFilter = None
         self.BASE = QColor(255, 0, 255)
         self.HIGHLIGHT = QColor(255, 255, 255, 0.75)
         self.threshold_current_value = float("-inf")
+        # Fixed (value, colour) class breakpoints kept next to the one the
+        # slider moves, which is threshold_current_value in HIGHLIGHT
+        self.breakpoints = []
         self.precision = 2
         self.increment = 1.0 / (10 ** self.precision)
         self.first_run = True
-        self.last_time = time.time() * 1000
+        # Upper bound on the pixel buffer the range scan reads per tile
+        self.tile_budget = int(QSettings().value('Threshold/tile_budget_mb', 64)) * 1024 * 1024
+        # Number of threads the range scan spreads its tiles over
+        self.threads = int(QSettings().value('Threshold/threads', QThread.idealThreadCount()))
+        # Ranges already computed, per layer, data source and band
+        self.stats_cache = None
+        self.watched_layers = set()
+        self.scanning = False
+        # Pixel windows reported by invalidate_region, per layer id, that
+        # wait for a rescan
+        self.dirty_regions = {}
+        # Ids of the layers reported to invalidate_region, whose scans keep
+        # per tile statistics
+        self.tracked_layers = set()
+        # Band being thresholded, and its statistics
+        self.band = 1
+        self.stats = None
+        # Low resolution preview drawn while the slider is dragged
+        self.preview = None
+        self.preview_ready = False
+        self.dragging = False
+        # Whether a canvas render started since the last repaint we asked
+        # for, i.e. whether the next refresh is the one drawing it
+        self.repaint_started = False
+        self.preview_scale = None
+        # Ranges persisted across sessions for file based rasters
+        self.disk_cache = None
 
         # Save reference to the QGIS interface
         self.iface = iface
@@ -118,9 +123,9 @@ class Threshold:
         self.actions = []
         self.menu = self.tr(u'&Threshold Plugin')
 
-        self.debounce_timer = QTimer()
-        self.debounce_timer.timeout.connect(self.render)
-        self.debounce_timer.setSingleShot(True)
+        # Coalesces threshold changes so only the newest value is rendered
+        self.scheduler = RenderScheduler(self.render, self.cancel_render)
+        self.scheduler.latencyMeasured.connect(self.on_latency_measured)
 
         ### SET MIN AND MAX HERE ###
         self.MIN = float("inf")
@@ -128,11 +133,38 @@ class Threshold:
         self.MIN_PROXY = float("inf")
         self.MAX_PROXY = float("-inf")
 
-        # TODO: We are going to let the user set this up in a future iteration
-        self.toolbar = self.iface.addToolBar(u'Threshold')
-        self.toolbar.setObjectName(u'Threshold')
+    def load(self):
+        """Build the dialog and the state behind it, once, on first use.
 
-        self.brightnessFilter = QgsBrightnessContrastFilter()
+        The dialog and the modules pulling in NumPy and GDAL are imported
+        here rather than at the top of the module, so that loading the
+        plugin at QGIS startup costs next to nothing for users who do not
+        open it. The modules are kept on the instance for the methods that
+        run once the dialog exists.
+        """
+        if self.dlg is not None:
+            return
+        from threshold_plugin_dialog import ThresholdDialog
+        import preview, range_resolver, stats_cache, threshold_core, Worker
+        self.previews = preview
+        self.resolver = range_resolver
+        self.caches = stats_cache
+        self.core = threshold_core
+        self.workers = Worker
+        self.dlg = ThresholdDialog()
+        # Per stage timings, see report_trace(); free when turned off
+        profiling.set_enabled(QSettings().value('Threshold/trace', False) in (True, 'true'))
+        self.stats_cache = stats_cache.StatsCache(int(QSettings().value('Threshold/cache_mb', 64)) * 1024 * 1024)
+        self.preview_scale = float(QSettings().value('Threshold/preview_scale', preview.DEFAULT_PREVIEW_SCALE))
+        if QSettings().value('Threshold/disk_cache', True) not in (False, 'false'):
+            self.disk_cache = stats_cache.DiskStatsCache(os.path.join(
+                QgsApplication.qgisSettingsDirPath(), 'threshold_cache'))
+
+    def get_color_picker(self):
+        if self.color_picker is None:
+            self.color_picker = QColorDialog()
+            self.color_picker.setOption(QColorDialog.ShowAlphaChannel, on=True)
+        return self.color_picker
 
     # noinspection PyMethodMayBeStatic
     def tr(self, message):
@@ -200,9 +232,6 @@ class Threshold:
         :rtype: QAction
         """
 
-        # Create the dialog (after translation) and keep reference
-        self.dlg = ThresholdDialog()
-
         icon = QIcon(icon_path)
         action = QAction(icon, text, parent)
         action.triggered.connect(callback)
@@ -215,7 +244,7 @@ class Threshold:
             action.setWhatsThis(whats_this)
 
         if add_to_toolbar:
-            self.toolbar.addAction(action)
+            self.iface.addToolBarIcon(action)
 
         if add_to_menu:
             self.iface.addPluginToMenu(
@@ -229,13 +258,19 @@ class Threshold:
     def initGui(self):
         """Create the menu entries and toolbar icons inside the QGIS GUI."""
 
-        icon_path = ':/plugins/Threshold/icon.png'
+        # Read from disk rather than from the compiled resources, whose
+        # 40 KB module would otherwise be imported at every QGIS startup
+        icon_path = os.path.join(self.plugin_dir, 'icon.png')
         self.add_action(
             icon_path,
             text=self.tr(u'Threshold'),
             callback=self.run,
             parent=self.iface.mainWindow())
 
+        QgsMapLayerRegistry.instance().layersWillBeRemoved.connect(self.on_layers_removed)
+        self.iface.mapCanvas().renderStarting.connect(self.on_render_starting)
+        self.iface.mapCanvas().mapCanvasRefreshed.connect(self.on_canvas_refreshed)
+
 
     def unload(self):
         """Removes the plugin menu item and icon from QGIS GUI."""
@@ -244,12 +279,20 @@ class Threshold:
                 self.tr(u'&Threshold Plugin'),
                 action)
             self.iface.removeToolBarIcon(action)
-        # remove the toolbar
-        del self.toolbar
+        QgsMapLayerRegistry.instance().layersWillBeRemoved.disconnect(self.on_layers_removed)
+        self.iface.mapCanvas().renderStarting.disconnect(self.on_render_starting)
+        self.iface.mapCanvas().mapCanvasRefreshed.disconnect(self.on_canvas_refreshed)
+        if self.preview is not None:
+            self.preview.remove()
+        if self.stats_cache is not None:
+            self.stats_cache.clear()
+        self.report_trace()
+        profiling.set_enabled(False)
 
 
     def run(self):
         """Run method that performs all the real work"""
+        self.load()
         # show the dialog
         self.dlg.show()
         self.toggleWidgets(False)
@@ -263,26 +306,24 @@ class Threshold:
                 return
             self.dlg.header.setText("") # Active layer 
             if not hasattr(self.layer, "hasFilter"):
+                if self.brightnessFilter is None:
+                    self.brightnessFilter = QgsBrightnessContrastFilter()
                 self.layer.pipe().set(self.brightnessFilter)
                 self.fcn = QgsColorRampShader()
                 self.fcn.setColorRampType(QgsColorRampShader.DISCRETE)
                 self.layer.hasFilter = True
 
-        ############################
-        ### COMMENT OUT STARTING HERE
-        if self.MAX == float("-inf"):
-
-            self.startWorker(self.iface, self.layer)
-            print("min: {}, max: {}".format(self.MIN, self.MAX))
-        else:
-            self.toggleWidgets(True)
-        ### COMMENT OUT ENDS HERE
-        #########################
+        self.watch_layer(self.layer)
+        if self.band > self.layer.bandCount():
+            self.band = 1
+        self.show_bands()
+        self.load_band()
 
         self.set_values()
 
         # Run the dialog event loop
         result = self.dlg.exec_()
+        self.report_trace()
 
         try: 
             self.dlg.base_color_button.clicked.disconnect()
@@ -324,6 +365,16 @@ class Threshold:
         print "min: {}, max: {}, current: {}".format(self.MIN, self.MAX, self.threshold_current_value)
         if self.first_run:
             self.dlg.threshold_slider.valueChanged.connect(lambda: self.on_changed("slider"))
+            self.dlg.threshold_slider.sliderPressed.connect(self.on_slider_pressed)
+            self.dlg.threshold_slider.sliderReleased.connect(self.on_slider_released)
+
+        if self.first_run:
+            self.dlg.band_combo.currentIndexChanged[int].connect(self.on_band_changed)
+            self.dlg.scan_button.clicked.connect(self.on_scan_clicked)
+            self.dlg.auto_apply_button.clicked.connect(self.on_auto_clicked)
+            self.dlg.add_class_button.clicked.connect(self.on_add_class_clicked)
+            self.dlg.remove_class_button.clicked.connect(self.on_remove_class_clicked)
+            self.dlg.export_button.clicked.connect(self.on_export_clicked)
 
         if self.first_run:
             self.dlg.base_color_button.clicked.connect(self.on_base_clicked)
@@ -343,6 +394,116 @@ class Threshold:
         
         self.first_run = False
 
+    def show_bands(self):
+        """Fill the band selector with the bands of the current layer."""
+        self.dlg.band_combo.blockSignals(True)
+        self.dlg.band_combo.clear()
+        for band in range(1, self.layer.bandCount() + 1):
+            self.dlg.band_combo.addItem(self.layer.bandName(band))
+        self.dlg.band_combo.setCurrentIndex(self.band - 1)
+        self.dlg.band_combo.blockSignals(False)
+
+    def load_band(self):
+        """Load the statistics of self.band, scanning only if none are known."""
+        stats = self.cached_stats(self.layer, self.band)
+        if stats is None:
+            stats = self.resolver.resolve_range(self.layer, self.band)
+            if stats is not None:
+                self.store_stats(self.layer, self.band, stats)
+        self.stats = stats
+        if stats is None:
+            self.MIN = float("inf")
+            self.MAX = float("-inf")
+            if not self.scanning:
+                self.startWorker(self.iface, self.layer)
+        else:
+            self.MIN = stats.minimum
+            self.MAX = stats.maximum
+            self.toggleWidgets(True)
+            self.show_range_status(stats.exact, stats.tier)
+
+    def on_band_changed(self, index):
+        if index < 0 or not isinstance(self.layer, QgsRasterLayer):
+            return
+        self.band = index + 1
+        if self.scanning and self.is_current(self.worker.layer):
+            # The scan publishes the range of the new band from here on
+            self.worker.band = self.band
+        if self.preview is not None:
+            self.preview.hide()
+        self.load_band()
+        self.set_values()
+        self.scheduler.schedule(10)
+
+    def on_scan_clicked(self):
+        """Replace the current range with an exact one from a full scan."""
+        if self.scanning or not isinstance(self.layer, QgsRasterLayer):
+            return
+        self.startWorker(self.iface, self.layer)
+
+    def suggest_threshold(self, method):
+        """Suggest a threshold from the cached histogram, or None without one.
+
+        :param method: One of 'Otsu', 'Triangle' or 'Percentile'.
+        :type method: str
+        """
+        histogram = self.stats.histogram if self.stats is not None else None
+        if histogram is None:
+            return None
+        return self.core.auto_threshold(histogram, method.lower(), self.dlg.percentile_box.value())
+
+    def on_auto_clicked(self):
+        value = self.suggest_threshold(self.dlg.auto_method_combo.currentText())
+        if value is None:
+            self.dlg.header.setText("No histogram yet, run a full scan first.")
+            return
+        self.dlg.threshold_box.setValue(min(max(value, self.MIN), self.MAX))
+
+    def class_breaks(self):
+        """All class breakpoints as an ascending list of (value, QColor).
+
+        Values at or below a breakpoint, and above the previous one, are
+        drawn in its colour; values above the last one are drawn in BASE.
+        """
+        breaks = self.breakpoints + [(self.threshold_current_value, self.HIGHLIGHT)]
+        return sorted(breaks, key=lambda item: item[0])
+
+    def on_add_class_clicked(self):
+        """Pin the current threshold and highlight colour as a class."""
+        self.breakpoints.append((self.threshold_current_value, QColor(self.HIGHLIGHT)))
+        self.breakpoints.sort(key=lambda item: item[0])
+        self.show_classes()
+
+    def on_remove_class_clicked(self):
+        row = self.dlg.class_list.currentRow()
+        if 0 <= row < len(self.breakpoints):
+            del self.breakpoints[row]
+            self.show_classes()
+            self.scheduler.schedule(10)
+
+    def show_classes(self):
+        self.dlg.class_list.clear()
+        for value, color in self.breakpoints:
+            item = QListWidgetItem("<= {}".format(value))
+            item.setBackground(QBrush(color))
+            self.dlg.class_list.addItem(item)
+
+    def on_export_clicked(self):
+        """Write the current classification of the band to a GeoTIFF."""
+        if not isinstance(self.layer, QgsRasterLayer):
+            return
+        nbits = 1 if self.dlg.export_format_combo.currentIndex() == 1 else 8
+        classes = self.class_breaks()
+        breaks = [value for value, _ in classes]
+        colors = [color.getRgb() for _, color in classes] + [self.BASE.getRgb()]
+        if nbits == 1 and len(breaks) != 1:
+            self.dlg.header.setText("A 1-bit mask needs a single threshold.")
+            return
+        path = QFileDialog.getSaveFileName(self.dlg, "Export mask", "", "GeoTIFF (*.tif)")
+        if not path:
+            return
+        self.startExport(self.layer, path, breaks, nbits, colors)
+
     def on_threshold_box_changed(self, value):
         print "value: {}".format(value)
 
@@ -362,7 +523,7 @@ class Threshold:
 
     def on_base_clicked(self):
         print("Base Clicked!")
-        self.BASE = self.color_picker.getColor(self.BASE)
+        self.BASE = self.get_color_picker().getColor(self.BASE)
         # self.dlg.base_color_value.setText(str(self.BASE.getRgb()))
         self.dlg.base_color_value.setStyleSheet("background-color: {}".format(self.BASE.name()))
         self.color_picker.done(0)
@@ -370,25 +531,133 @@ class Threshold:
 
     def on_highlight_clicked(self):
         print("Highlight Clicked!")
-        self.HIGHLIGHT = self.color_picker.getColor(self.HIGHLIGHT)
+        self.HIGHLIGHT = self.get_color_picker().getColor(self.HIGHLIGHT)
         # self.dlg.highlight_color_value.setText(str(self.HIGHLIGHT.getRgb()))
         self.dlg.highlight_color_value.setStyleSheet("background-color: {}".format(self.BASE.name()))
         self.color_picker.done(0)
         self.on_changed(None)
 
+    def layer_renderer(self, layer):
+        """Return the [renderer, shader function, ramp key] entry of layer.
+
+        The pseudo colour renderer is built and installed once per layer.
+        It is rebuilt only if something else replaced it on the layer, for
+        example the user picking another style in the layer properties.
+        """
+        entry = self.renderers.get(layer.id())
+        if entry is None or layer.renderer() is not entry[0]:
+            fcn = QgsColorRampShader()
+            fcn.setColorRampType(QgsColorRampShader.DISCRETE)
+            shader = QgsRasterShader()
+            shader.setRasterShaderFunction(fcn)
+            renderer = QgsSingleBandPseudoColorRenderer(layer.dataProvider(), self.band, shader)
+            layer.setRenderer(renderer)
+            entry = [renderer, fcn, None]
+            self.renderers[layer.id()] = entry
+        return entry
+
     def render(self):
-        lst = [QgsColorRampShader.ColorRampItem(self.threshold_current_value, self.HIGHLIGHT), QgsColorRampShader.ColorRampItem(255, self.BASE)]
-        self.fcn = QgsColorRampShader()
-        self.fcn.setColorRampType(QgsColorRampShader.DISCRETE) 
-        self.fcn.setColorRampItemList(lst)
-        self.shader = QgsRasterShader()
-        
-        self.shader.setRasterShaderFunction(self.fcn)
+        with profiling.tracer().span('render'):
+            return self.update_renderer()
+
+    def update_renderer(self):
+        self.scheduler.key = self.layer.id()
+        entry = self.layer_renderer(self.layer)
+        self.renderer, self.fcn = entry[0], entry[1]
+        self.shader = self.renderer.shader()
+
+        if self.renderer.band() != self.band:
+            self.renderer.setBand(self.band)
+        # Only rewrite the ramp when the band, a breakpoint or a colour moved
+        breaks = self.class_breaks()
+        key = (self.band, tuple((value, color.rgba()) for value, color in breaks), self.BASE.rgba())
+        if key != entry[2]:
+            # The last item catches everything above the last breakpoint,
+            # whatever the data type of the band
+            with profiling.tracer().span('render.shader'):
+                lst = [QgsColorRampShader.ColorRampItem(value, color) for value, color in breaks]
+                lst.append(QgsColorRampShader.ColorRampItem(float("inf"), self.BASE))
+                self.fcn.setColorRampItemList(lst)
+            entry[2] = key
+            self.repaint_started = False
+            with profiling.tracer().span('render.trigger'):
+                self.layer.triggerRepaint()
+            return True
+        if self.preview is not None:
+            # The layer already shows this value, the preview can go now
+            self.preview.hide()
+        return False
+
+    def cancel_render(self):
+        """Stop the canvas render started for a threshold that is now stale.
+
+        The canvas can only stop all of its layers at once, so this is only
+        done when the thresholded layer is the only one on it; otherwise
+        the render is left to finish. Returns whether it was stopped.
+        """
+        canvas = self.iface.mapCanvas()
+        if not canvas.isDrawing() or [layer.id() for layer in canvas.layers()] != [self.layer.id()]:
+            return False
+        canvas.stopRendering()
+        return True
 
-        self.renderer = QgsSingleBandPseudoColorRenderer(self.layer.dataProvider(), 1, self.shader)
-        
-        self.layer.setRenderer(self.renderer)
-        self.layer.triggerRepaint()
+    def on_slider_pressed(self):
+        """Switch to the low resolution preview for the length of the drag.
+
+        Layers measured to repaint faster than FAST_REPAINT are rendered
+        at full quality throughout the drag instead.
+        """
+        self.dragging = True
+        latency = self.scheduler.repaint.get(self.layer.id())
+        if latency is not None and latency < FAST_REPAINT:
+            self.preview_ready = False
+            return
+        if self.preview is None:
+            self.preview = self.previews.Preview(self.iface.mapCanvas(), self.preview_scale)
+        self.preview_ready = self.preview.prepare(self.layer, self.band, self.MIN, self.MAX, self.precision)
+
+    def render_diagnostics(self):
+        """Measured render timings of the current layer, for diagnosis.
+
+        :returns: Smoothed repaint time and current debounce interval in
+            ms, preview frame time in ms and preview scale, each None until
+            measured.
+        :rtype: dict
+        """
+        preview = self.preview
+        return {
+            'repaint_ms': self.scheduler.repaint.get(self.layer.id()) if self.layer else None,
+            'debounce_ms': self.scheduler.debounce(50),
+            'preview_frame_ms': preview.frame_time if preview else None,
+            'preview_scale': preview.scale if preview else self.preview_scale,
+            'renders': self.scheduler.generation,
+            'renders_cancelled': self.scheduler.cancelled,
+        }
+
+    def on_latency_measured(self, layer_id, latency):
+        diagnostics = self.render_diagnostics()
+        self.dlg.latency_label.setText("Repaint {:.0f} ms, debounce {} ms, preview {:.0%}".format(
+            latency, diagnostics['debounce_ms'], diagnostics['preview_scale']))
+
+    def on_slider_released(self):
+        """Leave the preview and render the final value at full quality."""
+        self.dragging = False
+        self.scheduler.schedule(0)
+
+    def on_render_starting(self):
+        if self.scheduler.in_flight:
+            self.repaint_started = True
+
+    def on_canvas_refreshed(self):
+        # Renders already under way when the repaint was asked for, or
+        # started by anything else, do not draw our threshold
+        if not self.repaint_started:
+            return
+        self.repaint_started = False
+        # A full quality render just landed, drop the preview on top of it
+        if self.preview is not None:
+            self.preview.hide()
+        self.scheduler.render_finished()
 
     def on_precision_changed(self):
         self.precision = self.dlg.precision_spinbox.value()
@@ -397,11 +666,10 @@ class Threshold:
         self.set_values()
 
     def on_changed(self, source):
-        if (time.time()*1000 - self.last_time) < 25:
-            return
-        else:
-            self.last_time = time.time() * 1000
-            print "Proceeding"
+        with profiling.tracer().span('on_changed'):
+            self.update_threshold(source)
+
+    def update_threshold(self, source):
         # brightness = self.dlg.brightness_slider.value()
         # contrast = self.dlg.contrast_slider.value()
         # self.dlg.brightness_value.setText(str(brightness))
@@ -429,12 +697,34 @@ class Threshold:
         self.dlg.threshold_box.setValue(threshold_value)
         # self.dlg.threshold_value.setText(str(threshold_value))
         self.threshold_current_value = threshold_value
+        with profiling.tracer().span('on_changed.count'):
+            self.show_threshold_count()
 
         # intiate render() 
-        if source == "box":
-            self.debounce_timer.start(10)
+        if self.dragging and self.preview_ready:
+            # Redraw the preview now and leave the full render until the
+            # slider is released or stays on one value for a moment
+            self.preview.show(self.class_breaks(), self.BASE)
+            self.scheduler.schedule(SETTLE_DELAY)
+        elif source == "box":
+            self.scheduler.schedule(10)
+        else:
+            self.scheduler.schedule(50)
+
+    def show_threshold_count(self):
+        """Show how many pixels lie above the threshold, from the histogram."""
+        histogram = self.stats.histogram if self.stats is not None else None
+        if histogram is None:
+            self.dlg.threshold_count_label.setText("")
+            return
+        fraction = histogram.fraction_above(self.threshold_current_value)
+        if histogram.sampled:
+            self.dlg.threshold_count_label.setText("~{:.2f}% above".format(fraction * 100))
         else:
-            self.debounce_timer.start(50)
+            # Counts within a bin are estimated unless bins hold one value
+            self.dlg.threshold_count_label.setText("{}{:,} px ({:.2f}%) above".format(
+                '' if histogram.exact else '~',
+                histogram.count_above(self.threshold_current_value), fraction * 100))
 
     def toggleWidgets(self, value):
         self.dlg.threshold_box.setEnabled(value)
@@ -443,11 +733,17 @@ class Threshold:
         self.dlg.highlight_color_button.setEnabled(value)
         self.dlg.base_color_alpha_slider.setEnabled(value)
         self.dlg.highlight_color_alpha_slider.setEnabled(value)
+        self.dlg.scan_button.setEnabled(value and not self.scanning)
+        self.dlg.auto_method_combo.setEnabled(value)
+        self.dlg.percentile_box.setEnabled(value)
+        self.dlg.auto_apply_button.setEnabled(value)
         pass
 
-    def startWorker(self, iface, layer):
-        worker = Worker(iface, layer)
-        messageBar = self.iface.messageBar().createMessage('Calculating range...', )
+    def startWorker(self, iface, layer, tiles=None):
+        worker = self.workers.Worker(iface, layer, tile_budget=self.tile_budget, threads=self.threads, band=self.band,
+                        tiles=tiles, keep_tiles=layer.id() in self.tracked_layers)
+        messageBar = self.iface.messageBar().createMessage(
+            'Updating range...' if tiles is not None else 'Calculating range...', )
         progressBar = QProgressBar()
         progressBar.setAlignment(Qt.AlignLeft|Qt.AlignVCenter)
         cancelButton = QPushButton()
@@ -464,13 +760,162 @@ class Threshold:
         worker.finished.connect(self.workerFinished)
         worker.error.connect(self.workerError)
         worker.progress.connect(progressBar.setValue)
+        worker.rangeUpdated.connect(self.workerRangeUpdated)
         thread.started.connect(worker.run)
         thread.start()
         self.thread = thread
         self.worker = worker
+        self.scanning = True
+        self.dlg.scan_button.setEnabled(False)
         pass
 
+    def startExport(self, layer, path, breaks, nbits, colors=None):
+        exporter = self.workers.ExportWorker(layer, self.band, path, breaks, nbits, self.threads, self.tile_budget, colors)
+        messageBar = self.iface.messageBar().createMessage('Exporting mask...', )
+        progressBar = QProgressBar()
+        progressBar.setAlignment(Qt.AlignLeft|Qt.AlignVCenter)
+        cancelButton = QPushButton()
+        cancelButton.setText('Cancel')
+        cancelButton.clicked.connect(exporter.kill)
+        messageBar.layout().addWidget(progressBar)
+        messageBar.layout().addWidget(cancelButton)
+        self.iface.messageBar().pushWidget(messageBar, self.iface.messageBar().INFO)
+        self.exportMessageBar = messageBar
+
+        thread = QThread()
+        exporter.moveToThread(thread)
+        exporter.finished.connect(self.exportFinished)
+        exporter.error.connect(self.workerError)
+        exporter.progress.connect(progressBar.setValue)
+        thread.started.connect(exporter.run)
+        thread.start()
+        self.exportThread = thread
+        self.exporter = exporter
+        self.dlg.export_button.setEnabled(False)
+
+    def exportFinished(self, ret):
+        path = self.exporter.path
+        self.exporter.deleteLater()
+        self.exportThread.quit()
+        self.exportThread.wait()
+        self.exportThread.deleteLater()
+        self.iface.messageBar().popWidget(self.exportMessageBar)
+        self.dlg.export_button.setEnabled(True)
+        if ret:
+            self.iface.messageBar().pushMessage('Mask written to {}'.format(path), duration=3)
+        else:
+            self.iface.messageBar().pushMessage('Mask export did not complete.', level=QgsMessageBar.WARNING, duration=3)
+
+    def workerRangeUpdated(self, band, _min, _max, exact):
+        """Apply an intermediate range while the scan is still running."""
+        if band != self.band or not self.is_current(self.worker.layer):
+            return
+        self.MIN = _min
+        self.MAX = _max
+        self.set_values()
+        self.toggleWidgets(True)
+        self.show_range_status(exact)
+
+    def show_range_status(self, exact, tier=None):
+        """Tell the user how the current range was obtained."""
+        tier = tier or self.caches.TIER_SCAN
+        if exact:
+            self.dlg.header.setText("Range: exact ({})".format(tier))
+        elif self.scanning:
+            self.dlg.header.setText("Range: sampled, refining...")
+        else:
+            self.dlg.header.setText("Range: sampled ({})".format(tier))
+
+    def cached_stats(self, layer, band):
+        """Look the statistics of band up in memory, then on disk."""
+        stats = self.stats_cache.get(layer.id(), layer.source(), band)
+        if stats is None and self.disk_cache is not None:
+            stats = self.disk_cache.get(layer.source(), band)
+            if stats is not None:
+                self.stats_cache.put(layer.id(), layer.source(), band, stats)
+        return stats
+
+    def store_stats(self, layer, band, stats):
+        self.stats_cache.put(layer.id(), layer.source(), band, stats)
+        if self.disk_cache is not None:
+            self.disk_cache.put(layer.source(), band, stats)
+
+    def watch_layer(self, layer):
+        """Drop the cached statistics of layer whenever its data changes."""
+        if layer.id() in self.watched_layers:
+            return
+        layer_id = layer.id()
+        layer.dataChanged.connect(lambda: self.stats_cache.invalidate(layer_id))
+        self.watched_layers.add(layer_id)
+
+    def invalidate_region(self, layer, extent):
+        """Update the statistics of layer after part of it was rewritten.
+
+        Meant for rasters updated in place while they are open, e.g. from
+        the Python console or a processing script once new tiles have been
+        written. Only the scan tiles overlapping extent are read again,
+        and the range and histogram of every band merged anew.
+
+        Per tile statistics cost memory, so they are only kept for layers
+        reported here at least once, and never written to the disk cache.
+        The first report for a layer, or one whose statistics have no
+        tiles, drops them and scans the layer in full, keeping its tiles
+        from then on.
+
+        :param layer: Layer whose pixels changed.
+        :type layer: QgsRasterLayer
+
+        :param extent: Area that changed, in the layer's CRS.
+        :type extent: QgsRectangle
+        """
+        self.load()
+        self.tracked_layers.add(layer.id())
+        window = self.workers.extent_window(layer.extent(), layer.height(), layer.width(), extent)
+        if window is None:
+            return
+        self.dirty_regions.setdefault(layer.id(), []).append(window)
+        if not self.scanning:
+            self.rescan_dirty()
+
+    def rescan_dirty(self):
+        """Start rescanning the regions reported by invalidate_region."""
+        while self.dirty_regions:
+            layer_id, windows = self.dirty_regions.popitem()
+            layer = QgsMapLayerRegistry.instance().mapLayer(layer_id)
+            if not isinstance(layer, QgsRasterLayer):
+                continue
+            bands = range(1, layer.bandCount() + 1)
+            stats = [self.stats_cache.get(layer_id, layer.source(), band) for band in bands]
+            tiles = [entry.tiles if entry is not None else None for entry in stats]
+            if None in tiles or any(
+                    (row + height, col + width) != (layer.height(), layer.width())
+                    for row, col, height, width in (entry.windows[-1] for entry in tiles)):
+                # Nothing to update from, or the raster changed size
+                self.stats_cache.invalidate(layer_id)
+                if self.disk_cache is not None:
+                    self.disk_cache.remove(layer.source())
+                self.startWorker(self.iface, layer)
+                return
+            for entry in tiles:
+                for window in windows:
+                    entry.invalidate_region(window)
+            self.startWorker(self.iface, layer, tiles)
+            return
+
+    def on_layers_removed(self, layer_ids):
+        for layer_id in layer_ids:
+            if self.stats_cache is not None:
+                self.stats_cache.invalidate(layer_id)
+            self.dirty_regions.pop(layer_id, None)
+            self.tracked_layers.discard(layer_id)
+            self.watched_layers.discard(layer_id)
+            self.renderers.pop(layer_id, None)
+
     def workerFinished(self, ret):
+        exact = not self.worker.killed
+        layer = self.worker.layer
+        tiles = self.worker.tiles
+        self.scanning = False
         # clean up the worker and thread
         self.worker.deleteLater()
         self.thread.quit()
@@ -479,18 +924,64 @@ class Threshold:
         # remove widget from message bar
         self.iface.messageBar().popWidget(self.messageBar)
         if ret is not None:
-            # report the result
-            _min, _max = ret
-            self.MIN = _min
-            self.MAX = _max
-            self.set_values()
-            self.toggleWidgets(True)
+            # report the result; the scan covered every band in one pass
+            for band, (_min, _max, histogram) in enumerate(ret, 1):
+                if _min <= _max:
+                    self.store_stats(layer, band, self.caches.LayerStats(
+                        _min, _max, exact, histogram=histogram, tiles=tiles[band - 1] if tiles else None))
+            if self.is_current(layer):
+                self.stats = self.stats_cache.get(layer.id(), layer.source(), self.band)
+                self.MIN, self.MAX = ret[self.band - 1][:2]
+                self.show_threshold_count()
+                self.set_values()
+                self.toggleWidgets(True)
+                if exact:
+                    self.show_range_status(True)
+                else:
+                    self.dlg.header.setText("Range: sampled (scan cancelled)")
+            self.dlg.scan_button.setEnabled(True)
 
             # self.iface.messageBar().pushMessage('min: {}, max: {}'.format(_min, _max))
         else:
             # notify the user that something went wrong
             self.iface.messageBar().pushMessage('Something went wrong! See the message log for more information.', level=QgsMessageBar.CRITICAL, duration=3)
+        # Regions reported dirty while this scan ran
+        if self.dirty_regions:
+            self.rescan_dirty()
+        # The dialog moved to a layer with no range while another one was
+        # scanned, and load_band() left its scan to this point
+        if not self.scanning and self.stats is None and isinstance(self.layer, QgsRasterLayer) \
+                and not self.is_current(layer):
+            self.startWorker(self.iface, self.layer)
+
+    def is_current(self, layer):
+        """Whether layer is the one the dialog is thresholding."""
+        return self.layer is not None and layer.id() == self.layer.id()
     
+    def report_trace(self):
+        """Log the stage timings recorded so far and write them as a trace.
+
+        The trace goes to Threshold/trace_path, which is overwritten every
+        time, or to a new threshold_trace_<time>.json in the QGIS settings
+        directory. It opens in chrome://tracing.
+        """
+        tracer = profiling.tracer()
+        if not tracer.enabled or not tracer.stages:
+            return
+        path = QSettings().value('Threshold/trace_path', '') or os.path.join(
+            QgsApplication.qgisSettingsDirPath(),
+            time.strftime('threshold_trace_%Y%m%d_%H%M%S.json'))
+        replaced = os.path.exists(path)
+        try:
+            tracer.write(path)
+            written = "Trace written to {}{}".format(
+                path, ", overwriting the previous trace" if replaced else "")
+        except (IOError, OSError), e:
+            written = "Could not write the trace to {}: {}".format(path, e)
+        QgsMessageLog.logMessage("{}\n{}".format(tracer.format_summary(), written),
+                                 'Threshold', QgsMessageLog.INFO)
+        tracer.clear()
+
     def workerError(self, e, exception_string):
         raise Exception("workerError {}".format(exception_string))
         pass